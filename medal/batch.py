@@ -0,0 +1,148 @@
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Optional
+
+from .jsonio import iter_jsonl, loads
+
+if TYPE_CHECKING:  # parsing results should not require the SDK
+    from openai import OpenAI
+
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelling", "cancelled"}
+
+
+def human_status(s: str) -> str:
+    return s.replace("_", " ")
+
+
+def chat_batch_line(custom_id: str, body: dict) -> dict:
+    """One request line of a Batch API input JSONL targeting chat completions."""
+    return {"custom_id": custom_id, "method": "POST", "url": CHAT_COMPLETIONS_URL, "body": body}
+
+
+def sniff_endpoint(fh: BinaryIO, default: str = CHAT_COMPLETIONS_URL) -> str:
+    """Endpoint ("url") of the first request line in `fh`, which is rewound afterwards."""
+    endpoint = default
+    for line in fh:
+        if not line.strip():
+            continue
+        try:
+            endpoint = loads(line).get("url", default)
+        except Exception:
+            pass
+        break
+    fh.seek(0)
+    return endpoint
+
+
+def submit_batch(
+    client: "OpenAI",
+    input_path: Path,
+    endpoint: Optional[str] = CHAT_COMPLETIONS_URL,
+    display_name: Optional[str] = None,
+):
+    """Upload a prepared JSONL and create a 24h batch job; returns (batch, file_obj).
+
+    With endpoint=None it is read from the first request line while the file
+    is open for the upload, so the input is opened only once.
+    """
+    with Path(input_path).open("rb") as fh:
+        if endpoint is None:
+            endpoint = sniff_endpoint(fh)
+        file_obj = client.files.create(file=fh, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=file_obj.id,
+        endpoint=endpoint,
+        completion_window="24h",
+        metadata={"display_name": display_name or f"MEDAL batch {Path(input_path).name}"},
+    )
+    return batch, file_obj
+
+
+def wait_for_batch(client: "OpenAI", batch_id: str, poll_seconds: int = 10, timeout_seconds: int = 36000):
+    """Poll until the batch reaches a terminal status; returns None on timeout."""
+    start = time.time()
+    while True:
+        b = client.batches.retrieve(batch_id)
+        print(f"Status: {human_status(b.status)} | succeeded={b.request_counts.completed} failed={b.request_counts.failed}")
+        if b.status in TERMINAL_STATUSES:
+            return b
+        if time.time() - start > timeout_seconds:
+            print("Timeout reached; exiting.")
+            return None
+        time.sleep(poll_seconds)
+
+
+def download_file(client: "OpenAI", file_id: str, path: Path, chunk_size: int = 1 << 20) -> Path:
+    """Stream a file's content to `path` in chunks rather than holding it all in memory."""
+    with client.files.with_streaming_response.content(file_id) as response, Path(path).open("wb") as w:
+        for chunk in response.iter_bytes(chunk_size):
+            w.write(chunk)
+    return Path(path)
+
+
+def response_text(result: dict) -> str:
+    """Extract the model's text from one Batch API output line (chat or responses shape)."""
+    body = (result.get("response") or {}).get("body") or {}
+    if result.get("url") == "/v1/responses" or body.get("id", "").startswith("resp_"):
+        output = body.get("output") or body.get("content") or []
+        parts = []
+        for item in output:
+            for c in item.get("content", []):
+                if "text" in c:
+                    t = c["text"]
+                    parts.append(t.get("value") if isinstance(t, dict) else str(t))
+        return "\n".join(parts)
+    return body.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+
+def parse_batch_results(path: Path, object_only: bool = True) -> Dict[str, Any]:
+    """Map each custom_id in a Batch API output JSONL to its parsed JSON reply.
+
+    A failed request, an unparseable reply, or (with object_only) a reply that
+    is not a JSON object maps to the exception instead, so one bad line never
+    aborts the whole batch. Lines that are not readable at all are reported
+    and skipped; their requests then show up as missing.
+    """
+    def report(i: int, e: Exception) -> None:
+        print(f"Skipping unreadable batch result line {i}: {e}")
+
+    replies: Dict[str, Any] = {}
+    for i, obj in iter_jsonl(path, on_error=report):
+        custom_id = obj.get("custom_id") if isinstance(obj, dict) else None
+        if not custom_id:
+            report(i, ValueError("no custom_id"))
+            continue
+        try:
+            if obj.get("error"):
+                raise RuntimeError(obj["error"])
+            reply = loads(response_text(obj))
+            if object_only and not isinstance(reply, dict):
+                raise ValueError(f"reply is a JSON {type(reply).__name__}, not an object")
+        except Exception as e:
+            reply = e
+        replies[custom_id] = reply
+    return replies
+
+
+def run_batch_job(
+    client: "OpenAI",
+    input_path: Path,
+    results_path: Path,
+    display_name: Optional[str] = None,
+    poll_seconds: int = 10,
+    object_only: bool = True,
+) -> Dict[str, Any]:
+    """Submit a prepared input JSONL, wait for it, download and parse the output.
+
+    Returns parse_batch_results() of the downloaded file; exits if the batch
+    ends (or times out) without an output file.
+    """
+    batch, _ = submit_batch(client, input_path, display_name=display_name)
+    print(f"Submitted batch: {batch.id}")
+    b = wait_for_batch(client, batch.id, poll_seconds=poll_seconds)
+    if b is None or not getattr(b, "output_file_id", None):
+        raise SystemExit(f"Batch {batch.id} produced no output; status={getattr(b, 'status', 'timeout')}")
+    download_file(client, b.output_file_id, results_path)
+    return parse_batch_results(results_path, object_only=object_only)
@@ -1,37 +1,331 @@
 import asyncio
-from typing import Optional
+import random
+from contextlib import nullcontext
+from itertools import islice
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, TypeVar, Union
 
-from openai import AsyncOpenAI
+import httpx
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI, RateLimitError
 
+try:
+    import h2  # optional, lets httpx multiplex requests over HTTP/2
+except Exception:
+    h2 = None
 
-def make_openai_async_client(api_key: Optional[str] = None) -> AsyncOpenAI:
-    return AsyncOpenAI(api_key=api_key)
+try:
+    import uvloop  # optional, libuv event loop (not available on Windows)
+except Exception:
+    uvloop = None
+
+from .jsonio import is_valid_json, loads
+from .llm_cache import LLMCache, cache_key
+from .ratelimit import AsyncRateLimiter, RequestTokenLimiter, estimate_tokens
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Completion budget charged against a TPM limit per call (one short JSON object)
+COMPLETION_TOKENS_ESTIMATE = 300
+
+MULTI_ITEM_INSTRUCTION = """
+Handle each numbered item below independently, exactly as if it had been sent on its own.
+Return a JSON object {"results": [...]} with one object per item. Each object must contain an integer "id" equal to the item number, plus the keys you would return for that item alone.
+""".strip()
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    # APITimeoutError is a subclass of APIConnectionError
+    if isinstance(exc, (APIConnectionError, RateLimitError, asyncio.TimeoutError)):
+        return True
+    return isinstance(exc, APIStatusError) and (
+        exc.status_code in RETRYABLE_STATUS_CODES or exc.status_code >= 500
+    )
+
+
+def _retry_after_seconds(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def error_category(exc: BaseException) -> str:
+    """Coarse label for a failed call, for per-run error counts: rate_limit, timeout, api or parse."""
+    if isinstance(exc, RateLimitError):
+        return "rate_limit"
+    if isinstance(exc, (APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(exc, (APIConnectionError, APIStatusError)):
+        return "api"
+    # Malformed JSON replies raise ValueError (json and orjson decode errors alike)
+    if isinstance(exc, ValueError):
+        return "parse"
+    return "other"
+
+
+async def call_with_retries(
+    make_call: Callable[[], Awaitable[T]],
+    limiter: Optional[Union[AsyncRateLimiter, RequestTokenLimiter]] = None,
+    max_attempts: int = 6,
+    min_wait: float = 1.0,
+    max_wait: float = 30.0,
+    tokens: float = 0.0,
+) -> T:
+    """Await `make_call()`, retrying transient API errors with jittered exponential backoff.
+
+    A server-sent Retry-After takes precedence over the computed delay, and on a
+    429 it also pauses `limiter`, so other tasks stop sending doomed requests
+    instead of each discovering the limit on its own. Each attempt re-acquires
+    `limiter`, so retries count against the request rate; `tokens` is charged
+    to a RequestTokenLimiter on the first attempt only, since only the attempt
+    that succeeds reports usage to reconcile the charge against.
+    """
+    for attempt in range(max_attempts):
+        if limiter is not None:
+            charge = tokens if attempt == 0 else 0.0
+            await (limiter.acquire(charge) if charge else limiter.acquire())
+        try:
+            return await make_call()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not _is_retryable(e):
+                raise
+            delay = _retry_after_seconds(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_wait, min_wait * 2 ** attempt))
+            elif limiter is not None and isinstance(e, RateLimitError):
+                limiter.pause(delay)
+            await asyncio.sleep(delay)
+    raise RuntimeError("max_attempts must be at least 1")
+
+
+def run_async(main: Awaitable[T]) -> T:
+    """asyncio.run(main), on uvloop when it is installed."""
+    if uvloop is not None:
+        return uvloop.run(main)
+    return asyncio.run(main)
+
+
+async def run_worker_pool(
+    items: Union[Iterable[T], AsyncIterable[T]],
+    handle: Callable[[T], Awaitable[None]],
+    num_workers: int,
+) -> None:
+    """Feed `items` to `num_workers` coroutines through a bounded queue.
+
+    Unlike creating one task per item up front, only about 2 * num_workers items
+    are materialised at a time, so memory stays flat however large the input is.
+    `items` may be an async iterable, e.g. one draining an earlier pool's output.
+    Exceptions from `handle` are reported and do not stop the pool.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=num_workers * 2)
+    stop = object()
+
+    async def worker() -> None:
+        while True:
+            item = await queue.get()
+            if item is stop:
+                return
+            try:
+                await handle(item)
+            except Exception as e:
+                print(f"Worker error: {e}")
+
+    async def produce() -> None:
+        if hasattr(items, "__aiter__"):
+            async for item in items:
+                await queue.put(item)
+        else:
+            for item in items:
+                await queue.put(item)
+        for _ in range(num_workers):
+            await queue.put(stop)
+
+    await asyncio.gather(produce(), *(worker() for _ in range(num_workers)))
+
+
+async def run_bounded(
+    items: Union[Iterable[T], AsyncIterable[T]],
+    handle: Callable[[T], Awaitable[R]],
+    num_workers: int,
+    write: Callable[[R], None],
+) -> None:
+    """run_worker_pool whose results are handed to `write` by one consumer task.
+
+    Workers only compute; every result passes through a bounded queue to a single
+    writer in completion order, so output never interleaves and slow writes
+    push back on the workers instead of piling up in memory.
+    """
+    results: asyncio.Queue = asyncio.Queue(maxsize=num_workers * 2)
+    stop = object()
+
+    async def work(item: T) -> None:
+        await results.put(await handle(item))
+
+    async def produce() -> None:
+        try:
+            await run_worker_pool(items, work, num_workers)
+        finally:
+            await results.put(stop)
+
+    async def consume() -> None:
+        while (result := await results.get()) is not stop:
+            try:
+                write(result)
+            except Exception as e:
+                print(f"Writer error: {e}")
+
+    await asyncio.gather(produce(), consume())
+
+
+async def prewarm_connections(client: AsyncOpenAI, count: int) -> None:
+    """Open up to `count` pooled connections with cheap model-list calls before a burst.
+
+    Without this, the first `count` real requests all pay TCP+TLS setup at the
+    same moment. Failures are ignored; the real requests will surface them.
+    """
+    # With HTTP/2 every request shares one connection, so one call is enough
+    count = 1 if h2 is not None else max(1, count)
+    await asyncio.gather(*(client.models.list() for _ in range(count)), return_exceptions=True)
+
+
+def json_response_format(json_schema: Optional[dict] = None) -> dict:
+    """Chat Completions response_format: strict structured outputs if a schema is given, else JSON mode."""
+    if json_schema is None:
+        return {"type": "json_object"}
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "response", "schema": json_schema, "strict": True},
+    }
+
+
+def make_openai_async_client(
+    api_key: Optional[str] = None,
+    max_connections: int = 100,
+    base_url: Optional[str] = None,
+    default_headers: Optional[dict] = None,
+    read_timeout: float = 600.0,
+) -> AsyncOpenAI:
+    """AsyncOpenAI on one pooled keep-alive transport, using HTTP/2 when `h2` is installed.
+
+    `base_url`/`default_headers` point it at an OpenAI-compatible provider such as
+    OpenRouter. Close it with `await client.close()` when done.
+    """
+    http_client = httpx.AsyncClient(
+        http2=h2 is not None,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=75,
+        ),
+        # Defaults to the SDK's 10 minute read timeout; slow reasoning calls need it
+        timeout=httpx.Timeout(read_timeout, connect=10.0),
+    )
+    return AsyncOpenAI(
+        api_key=api_key, base_url=base_url, default_headers=default_headers, http_client=http_client
+    )
 
 
 async def bounded_json_chat_completion(
     client: AsyncOpenAI,
     model: str,
     prompt: str,
-    semaphore: asyncio.Semaphore,
+    semaphore: Optional[asyncio.Semaphore],
     temperature: Optional[float] = 0.2,
     reasoning_effort: Optional[str] = None,
+    cache: Optional[LLMCache] = None,
+    limiter: Optional[Union[AsyncRateLimiter, RequestTokenLimiter]] = None,
+    system_prompt: Optional[str] = None,
+    json_schema: Optional[dict] = None,
 ) -> str:
-    async with semaphore:
+    """Run one JSON completion under the semaphore (and optional cache/limiter).
+
+    With a RequestTokenLimiter, the call is charged the estimated prompt +
+    completion tokens before it is first sent, and the charge is corrected to
+    the reported usage afterwards; the semaphore still caps requests in flight.
+    Pass semaphore=None when the caller already bounds concurrency, e.g. with
+    run_worker_pool.
+
+    `system_prompt` carries instructions shared by every call; keeping them in a
+    stable leading system message lets the provider's prompt cache reuse them.
+    `json_schema` switches from JSON mode to strict structured outputs, so the
+    reply is guaranteed to parse and match the schema.
+    """
+    key = None
+    if cache is not None:
+        key = cache_key(
+            model,
+            prompt,
+            temperature,
+            reasoning_effort=reasoning_effort,
+            system_prompt=system_prompt,
+            json_schema=json_schema,
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    text = await _bounded_json_chat_completion(
+        client, model, prompt, semaphore, temperature, reasoning_effort, limiter, system_prompt, json_schema
+    )
+    # Unparseable replies are not cached, so a re-run asks again instead of
+    # replaying the same ERROR row
+    if cache is not None and text and is_valid_json(text):
+        cache.set(key, text)
+    return text
+
+
+async def _bounded_json_chat_completion(
+    client: AsyncOpenAI,
+    model: str,
+    prompt: str,
+    semaphore: Optional[asyncio.Semaphore],
+    temperature: Optional[float],
+    reasoning_effort: Optional[str],
+    limiter: Optional[Union[AsyncRateLimiter, RequestTokenLimiter]],
+    system_prompt: Optional[str],
+    json_schema: Optional[dict],
+) -> str:
+    tokens = 0
+    if isinstance(limiter, RequestTokenLimiter):
+        tokens = estimate_tokens((system_prompt or "") + prompt) + COMPLETION_TOKENS_ESTIMATE
+
+    def reconcile(result) -> None:
+        actual = getattr(getattr(result, "usage", None), "total_tokens", None)
+        if tokens and actual:
+            limiter.reconcile(tokens, actual)
+
+    async with semaphore if semaphore is not None else nullcontext():
         # Use Responses API for GPT-5 family
         if model.startswith("gpt-5"):
-            # Try Responses API with reasoning; fall back if unsupported
-            try:
-                resp = await client.responses.create(
-                    model=model,
-                    input=prompt,
-                    reasoning={"effort": reasoning_effort} if reasoning_effort else None,
-                )
-            except TypeError:
-                # Retry without reasoning field for older SDKs
-                resp = await client.responses.create(
-                    model=model,
-                    input=prompt,
-                )
+            instructions = {"instructions": system_prompt} if system_prompt else {}
+            if json_schema is not None:
+                instructions["text"] = {
+                    "format": {"type": "json_schema", "name": "response", "schema": json_schema, "strict": True}
+                }
+
+            async def create_response():
+                # Try Responses API with reasoning; fall back if unsupported
+                try:
+                    return await client.responses.create(
+                        model=model,
+                        input=prompt,
+                        reasoning={"effort": reasoning_effort} if reasoning_effort else None,
+                        **instructions,
+                    )
+                except TypeError:
+                    # Retry without reasoning field for older SDKs
+                    return await client.responses.create(
+                        model=model,
+                        input=prompt,
+                        **instructions,
+                    )
+
+            resp = await call_with_retries(create_response, limiter, tokens=tokens)
+            reconcile(resp)
             # Try convenient property first
             text = getattr(resp, "output_text", None)
             if text:
@@ -54,15 +348,107 @@ async def bounded_json_chat_completion(
             return str(resp)
 
         # Otherwise, use Chat Completions API
+        messages = [{"role": "user", "content": prompt}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
         payload = {
             "model": model,
-            "messages": [{"role": "user", "content": prompt}],
-            "response_format": {"type": "json_object"},
+            "messages": messages,
+            "response_format": json_response_format(json_schema),
         }
         if temperature is not None:
             payload["temperature"] = temperature
-        completion = await client.chat.completions.create(**payload)
+        completion = await call_with_retries(
+            lambda: client.chat.completions.create(**payload), limiter, tokens=tokens
+        )
+        reconcile(completion)
         return completion.choices[0].message.content
 
 
+def chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Consecutive lists of up to `size` items, drawn lazily from `items`."""
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def build_multi_item_prompt(prompts: List[str]) -> str:
+    """Number several prompts into one user message answered as {"results": [...]}."""
+    return "\n\n".join(
+        [MULTI_ITEM_INSTRUCTION] + [f"Item {i}:\n{p}" for i, p in enumerate(prompts, start=1)]
+    )
+
+
+def split_multi_item_reply(content: str, count: int) -> List[Optional[dict]]:
+    """Map a reply to `build_multi_item_prompt` back to one dict (or None if missing) per item."""
+    data = loads(content)
+    results = data.get("results") if isinstance(data, dict) else data
+    by_id = {}
+    for r in results if isinstance(results, list) else []:
+        if not isinstance(r, dict):
+            continue
+        try:
+            by_id[int(r.get("id"))] = {k: v for k, v in r.items() if k != "id"}
+        except (TypeError, ValueError):
+            continue
+    return [by_id.get(i) for i in range(1, count + 1)]
+
+
+async def resolve_grouped(
+    keys: Iterable[str],
+    answers: Dict[str, "asyncio.Future"],
+    ask_many: Callable[[List[str]], Awaitable[List[Optional[dict]]]],
+    ask_one: Callable[[str], Awaitable[dict]],
+) -> None:
+    """Resolve the distinct `keys` not yet in `answers` with one grouped request.
+
+    A future per new key is stored in `answers` before anything is awaited, so
+    concurrent groups sharing a key wait for it instead of asking again. Keys
+    the grouped reply leaves out, or all of them if it fails, are asked alone.
+    """
+    new = [k for k in dict.fromkeys(keys) if k not in answers]
+    loop = asyncio.get_running_loop()
+    for k in new:
+        answers[k] = loop.create_future()
+    replies: List[Optional[dict]] = [None] * len(new)
+    if len(new) > 1:
+        try:
+            replies = await ask_many(new)
+        except Exception:
+            pass
+    for k, reply in zip(new, replies):
+        try:
+            answers[k].set_result(reply if reply is not None else await ask_one(k))
+        except Exception as e:
+            answers[k].set_exception(e)
+
+
+async def bounded_json_chat_completion_multi(
+    client: AsyncOpenAI,
+    model: str,
+    prompts: List[str],
+    semaphore: Optional[asyncio.Semaphore],
+    temperature: Optional[float] = 0.2,
+    reasoning_effort: Optional[str] = None,
+    limiter: Optional[Union[AsyncRateLimiter, RequestTokenLimiter]] = None,
+    system_prompt: Optional[str] = None,
+) -> List[Optional[dict]]:
+    """Answer several prompts that share `system_prompt` with one request.
 
+    The prompts are numbered in a single user message and the reply is split
+    back by id, so one round trip and one RPM slot serve every prompt. Items the
+    reply leaves out come back as None, for the caller to re-ask on their own.
+    Only group prompts whose instructions are the same.
+    """
+    content = await _bounded_json_chat_completion(
+        client,
+        model,
+        build_multi_item_prompt(prompts),
+        semaphore,
+        temperature,
+        reasoning_effort,
+        limiter,
+        system_prompt,
+        None,
+    )
+    return split_multi_item_reply(content, len(prompts))
@@ -1,9 +1,11 @@
 import os
+from functools import lru_cache
 from pathlib import Path
 
 
+@lru_cache(maxsize=None)
 def load_dotenv_if_present() -> None:
-    """Load environment variables from a .env file if it exists."""
+    """Load environment variables from a .env file if it exists (once per process)."""
     try:
         from dotenv import load_dotenv
     except Exception:
@@ -0,0 +1,77 @@
+from pathlib import Path
+from typing import Dict, Optional
+
+from .clients import json_response_format
+from .jsonio import iter_jsonl
+
+
+EVAL_PROMPT = """
+You are a clinical research expert with knowledge of systematic reviews, RCTs, and observational studies.
+Task: Given a clinical question, return a JSON with keys question, answer, evidence-quality, discrepancy, notes.
+Allowed values:
+- answer: Yes | No | No Evidence
+- evidence-quality: High | Moderate | Low | Very Low | Missing
+- discrepancy: Yes | No | Missing
+""".strip()
+
+# Only the question varies per call; EVAL_PROMPT is sent as a fixed system prefix
+QUESTION_TEMPLATE = 'Question:\n"""{question}"""'
+
+
+def error_response(question: str, error) -> dict:
+    return {
+        "question": question,
+        "answer": "ERROR",
+        "evidence-quality": "ERROR",
+        "discrepancy": "ERROR",
+        "notes": str(error),
+    }
+
+
+def make_row(item: dict, resp: dict) -> dict:
+    """One evaluation record; the live and batch paths both emit exactly this shape."""
+    return {
+        "doi": item.get("doi", ""),
+        "question": item["question"],
+        "model_answer": resp.get("answer", ""),
+        "model_evidence-quality": resp.get("evidence-quality", ""),
+        "model_discrepancy": resp.get("discrepancy", ""),
+        "model_notes": resp.get("notes", ""),
+        "ground_truth_answer": item.get("answer", ""),
+        "ground_truth_evidence-quality": item.get("evidence-quality", ""),
+        "ground_truth_discrepancy": item.get("discrepancy", ""),
+    }
+
+
+def is_error_row(row: dict) -> bool:
+    """ERROR rows are never checkpointed, so a resumed run retries them."""
+    return row.get("model_answer") == "ERROR"
+
+
+def load_checkpoint(path: Path) -> Dict[str, dict]:
+    """Rows already in an append-only {idx: row} checkpoint JSONL.
+
+    A torn final line from an interrupted run is skipped, and ERROR rows are
+    dropped in case an older checkpoint still holds some.
+    """
+    out = {}
+    for _, obj in iter_jsonl(path):
+        if isinstance(obj, dict):
+            out.update((idx, row) for idx, row in obj.items() if isinstance(row, dict) and not is_error_row(row))
+    return out
+
+
+def eval_request_body(model: str, question: str, json_schema: Optional[dict] = None) -> dict:
+    """Chat Completions body for one question, as sent by the batch path."""
+    body = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": EVAL_PROMPT},
+            {"role": "user", "content": QUESTION_TEMPLATE.format(question=question)},
+        ],
+        "response_format": json_response_format(json_schema),
+    }
+    # gpt-5 models reject a custom temperature
+    if not model.startswith("gpt-5"):
+        body["temperature"] = 0.2
+    return body
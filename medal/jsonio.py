@@ -0,0 +1,96 @@
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, Tuple, Union
+
+try:
+    import orjson  # optional, much faster than the stdlib encoder
+except Exception:
+    orjson = None
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def is_valid_json(data: Union[str, bytes]) -> bool:
+    try:
+        loads(data)
+    except Exception:
+        return False
+    return True
+
+
+def iter_lines(path: Path) -> Iterator[Tuple[int, bytes]]:
+    """Yield (line_number, raw_line) for each non-blank line of a file, without the newline.
+
+    The file is memory-mapped and split on newlines in C, so lines are sliced
+    straight out of the page cache instead of going through buffered reads.
+    """
+    with Path(path).open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start, size, i = 0, len(mm), 0
+            while start < size:
+                nl = mm.find(b"\n", start)
+                stop = size if nl < 0 else nl
+                line = mm[start:stop]
+                start = stop + 1
+                if line.strip():
+                    yield i, line
+                i += 1
+
+
+def iter_jsonl(
+    path: Path, on_error: Optional[Callable[[int, Exception], None]] = None
+) -> Iterator[Tuple[int, Any]]:
+    """Yield (line_number, record) from a JSONL file, parsing one line at a time.
+
+    Blank lines are skipped; unparseable ones are skipped after `on_error` is called.
+    Line numbers count every line, so they stay stable as row ids across runs.
+    """
+    for i, line in iter_lines(path):
+        try:
+            record = loads(line)
+        except Exception as e:
+            if on_error is not None:
+                on_error(i, e)
+            continue
+        yield i, record
+
+
+def has_torn_tail(path: Path) -> bool:
+    """True if `path` is non-empty and does not end in a newline.
+
+    That is a JSONL line cut off by an interrupted run; appending to the file
+    should start with a newline so the next record is not glued onto it.
+    """
+    with Path(path).open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+
+def dumps_line(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """Serialize `obj` as one compact JSONL line (UTF-8, trailing newline).
+
+    `default` converts values JSON cannot represent, as in json.dumps.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=default) + b"\n"
+    return (json.dumps(obj, ensure_ascii=False, default=default) + "\n").encode("utf-8")
+
+
+def write_json(path: Path, obj: Any, indent: bool = True, default: Optional[Callable[[Any], Any]] = None) -> None:
+    """Write `obj` to `path` as JSON, pretty-printed with 2 spaces by default."""
+    if orjson is not None:
+        data = orjson.dumps(obj, default=default, option=orjson.OPT_INDENT_2 if indent else 0)
+    else:
+        data = json.dumps(obj, indent=2 if indent else None, ensure_ascii=False, default=default).encode("utf-8")
+    with Path(path).open("wb") as w:
+        w.write(data)
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+
+def cache_key(
+    model: str,
+    prompt: str,
+    temperature: Optional[float] = None,
+    **params,
+) -> str:
+    """Stable SHA-256 key over the request parameters that determine a response."""
+    payload = {"model": model, "prompt": prompt, "temperature": temperature}
+    payload.update({k: v for k, v in params.items() if v is not None})
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """On-disk prompt/response cache backed by a single SQLite table."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, response: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cache (key, response) VALUES (?, ?)", (key, response)
+        )
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def open_cache_from_env(name: str = "MEDAL_LLM_CACHE") -> Optional[LLMCache]:
+    """Open the response cache at the path in `name`, or return None if unset."""
+    raw = os.getenv(name)
+    if not raw:
+        return None
+    return LLMCache(Path(raw).expanduser())
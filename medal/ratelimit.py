@@ -0,0 +1,121 @@
+import asyncio
+import time
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import tiktoken  # optional, exact token counts
+except Exception:
+    tiktoken = None
+
+
+class AsyncRateLimiter:
+    """Leaky-bucket limiter allowing `max_rate` acquisitions per `time_period` seconds.
+
+    Unlike a semaphore, which only caps requests in flight, this caps the request
+    rate, so fast responses cannot push a run past a provider's per-minute limit.
+    Only `burst` of the budget is free at start and the rest accrues at the
+    steady rate, so a cold start does not fire a whole minute's worth at once.
+    """
+
+    def __init__(self, max_rate: float, time_period: float = 60.0, burst: float = 0.25) -> None:
+        if max_rate <= 0 or time_period <= 0:
+            raise ValueError("max_rate and time_period must be positive")
+        if not 0 < burst <= 1:
+            raise ValueError("burst must be in (0, 1]")
+        self.max_rate = float(max_rate)
+        self.time_period = float(time_period)
+        self._rate_per_sec = self.max_rate / self.time_period
+        self._level = self.max_rate * (1.0 - burst)
+        self._last = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _leak(self) -> None:
+        now = time.monotonic()
+        self._level = max(0.0, self._level - (now - self._last) * self._rate_per_sec)
+        self._last = now
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        # The lock keeps waiters in arrival order
+        async with self._lock:
+            while True:
+                paused = self._resume_at - time.monotonic()
+                if paused > 0:
+                    await asyncio.sleep(paused)
+                    continue
+                self._leak()
+                if self._level + amount <= self.max_rate:
+                    self._level += amount
+                    return
+                await asyncio.sleep((self._level + amount - self.max_rate) / self._rate_per_sec)
+
+    def adjust(self, amount: float) -> None:
+        """Correct an earlier charge by `amount` (negative to refund), e.g. once real usage is known."""
+        self._leak()
+        self._level = max(0.0, self._level + amount)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every acquirer for `seconds`, e.g. when the provider answers 429 with Retry-After."""
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    async def __aenter__(self) -> "AsyncRateLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: Optional[str]):
+    try:
+        return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("o200k_base")
+    except KeyError:
+        # Models tiktoken does not know (e.g. OpenRouter ids) get the current default
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Token count of `text` for `model` with tiktoken, or estimate_tokens without it."""
+    if tiktoken is None:
+        return estimate_tokens(text)
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+class RequestTokenLimiter:
+    """Caps requests per minute and tokens per minute together.
+
+    Each call is charged one request plus its estimated prompt+completion tokens.
+    Either budget may be None to leave it uncapped.
+    """
+
+    def __init__(self, max_rpm: Optional[float] = None, max_tpm: Optional[float] = None) -> None:
+        self.requests = AsyncRateLimiter(max_rpm, 60.0) if max_rpm else None
+        self.tokens = AsyncRateLimiter(max_tpm, 60.0) if max_tpm else None
+
+    async def acquire(self, tokens: float = 0.0) -> None:
+        if self.requests is not None:
+            await self.requests.acquire()
+        if self.tokens is not None and tokens > 0:
+            # A single call larger than the whole budget could otherwise never proceed
+            await self.tokens.acquire(min(tokens, self.tokens.max_rate))
+
+    def pause(self, seconds: float) -> None:
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.pause(seconds)
+
+    def reconcile(self, estimated: float, actual: float) -> None:
+        """Replace the estimate charged by `acquire` with the usage the API reported.
+
+        call_with_retries charges the estimate on the first attempt only, so
+        this corrects the single charge a call made, however many retries it took.
+        """
+        if self.tokens is not None and estimated > 0:
+            self.tokens.adjust(actual - min(estimated, self.tokens.max_rate))
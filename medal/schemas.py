@@ -1,11 +1,38 @@
-from typing import Literal, Optional
-from pydantic import BaseModel, Field
+from typing import Annotated, List, Literal, Optional, Union, get_args
+from pydantic import BaseModel, Field, TypeAdapter, field_validator
 
 
 Answer = Literal["Yes", "No", "No Evidence"]
 EvidenceQuality = Literal["High", "Moderate", "Low", "Very Low", "Missing"]
 Discrepancy = Literal["Yes", "No", "Missing"]
 
+# JSON Schema of a model's assessment of one question, usable with OpenAI strict
+# structured outputs (every key required, no extra keys) and as tool parameters
+ASSESSMENT_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "question": {"type": "string"},
+        "answer": {"type": "string", "enum": list(get_args(Answer))},
+        "evidence-quality": {"type": "string", "enum": list(get_args(EvidenceQuality))},
+        "discrepancy": {"type": "string", "enum": list(get_args(Discrepancy))},
+        "notes": {"type": "string"},
+    },
+    "required": ["question", "answer", "evidence-quality", "discrepancy", "notes"],
+    "additionalProperties": False,
+}
+
+
+class Assessment(BaseModel):
+    """A model's reply for one question, as described by ASSESSMENT_JSON_SCHEMA."""
+    question: Optional[str] = ""
+    answer: Answer
+    evidence_quality: EvidenceQuality = Field(alias="evidence-quality")
+    discrepancy: Discrepancy
+    notes: Optional[str] = ""
+
+    class Config:
+        populate_by_name = True
+
 
 class QAPair(BaseModel):
     doi: str
@@ -37,5 +64,41 @@ class EvalRecord(BaseModel):
         populate_by_name = True
 
 
+class GuidelineQA(BaseModel):
+    """One question generated from a guideline slice; missing or null fields read as ""."""
+    question: str = ""
+    answer: str = ""
+    category: str = ""
+    supporting_snippet: str = ""
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def _none_as_empty(cls, v):
+        return "" if v is None else v
+
+    class Config:
+        coerce_numbers_to_str = True
+
+
+class GuidelineQAList(BaseModel):
+    questions: List[GuidelineQA]
+
+
+# Built once: validates a raw reply straight from JSON text, whether the model
+# returned an array, a {"questions": [...]} wrapper, or a single object
+GUIDELINE_QA_REPLY = TypeAdapter(
+    Annotated[Union[List[GuidelineQA], GuidelineQAList, GuidelineQA], Field(union_mode="left_to_right")]
+)
 
 
+def parse_guideline_qa(content: Union[str, bytes]) -> List[dict]:
+    """QA items that have a question, from a guideline-generation reply; raises ValidationError on other shapes."""
+    reply = GUIDELINE_QA_REPLY.validate_json(content)
+    if isinstance(reply, GuidelineQAList):
+        items = reply.questions
+    elif isinstance(reply, GuidelineQA):
+        items = [reply]
+    else:
+        items = reply
+    # A row without a question is of no use downstream, whatever else it holds
+    return [item.model_dump() for item in items if item.question]
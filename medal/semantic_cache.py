@@ -0,0 +1,74 @@
+import json
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+try:
+    import numpy as np  # optional
+except Exception:
+    np = None
+
+
+class SemanticCache:
+    """Embedding-similarity cache: reuse a stored response for near-identical inputs.
+
+    Embeddings are L2-normalised so the inner product is the cosine similarity.
+    """
+
+    def __init__(self, threshold: float = 0.97) -> None:
+        if np is None:
+            raise RuntimeError("SemanticCache requires numpy. Install it with `pip install numpy`.")
+        self.threshold = threshold
+        self._matrix = None
+        self._size = 0
+        self._responses: List[dict] = []
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]):
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+    def lookup(self, embedding: Sequence[float]) -> Optional[dict]:
+        """Return the cached response with the highest similarity above threshold."""
+        if not self._size:
+            return None
+        scores = self._matrix[: self._size] @ self._normalize(embedding)
+        best = int(np.argmax(scores))
+        if scores[best] > self.threshold:
+            return self._responses[best]
+        return None
+
+    def add(self, embedding: Sequence[float], response: dict) -> None:
+        vec = self._normalize(embedding)
+        if self._matrix is None:
+            self._matrix = np.empty((64, vec.shape[0]), dtype=np.float32)
+        elif self._size == self._matrix.shape[0]:
+            grown = np.empty((self._size * 2, self._matrix.shape[1]), dtype=np.float32)
+            grown[: self._size] = self._matrix
+            self._matrix = grown
+        self._matrix[self._size] = vec
+        self._size += 1
+        self._responses.append(response)
+
+    def save(self, path: Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        vectors = self._matrix[: self._size] if self._size else np.empty((0, 0), dtype=np.float32)
+        with path.open("wb") as f:
+            np.savez(f, vectors=vectors, responses=np.array(json.dumps(self._responses)))
+
+    @classmethod
+    def load(cls, path: Path, threshold: float = 0.97) -> "SemanticCache":
+        cache = cls(threshold=threshold)
+        path = Path(path)
+        if not path.exists():
+            return cache
+        with np.load(path) as data:
+            vectors = data["vectors"]
+            responses = json.loads(str(data["responses"]))
+        for vec, response in zip(vectors, responses):
+            cache.add(vec, response)
+        return cache
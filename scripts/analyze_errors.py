@@ -5,13 +5,17 @@ ROOT_DIR = _P(__file__).resolve().parents[1]
 if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 import argparse
+import bisect
 import csv
 import json
 from collections import Counter, defaultdict
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Optional
 import math
 
+from medal.jsonio import iter_jsonl
+
 try:
     import matplotlib.pyplot as plt  # optional
 except Exception:
@@ -24,11 +28,46 @@ try:
     from scipy import stats  # optional
 except Exception:
     stats = None
-
-
-YES_NO_NOE = {"Yes", "No", "No Evidence"}
-QUALITY_SET = {"High", "Moderate", "Low", "Very Low", "Missing"}
-DISC_SET = {"Yes", "No", "Missing"}
+try:
+    import pyarrow as pa  # optional
+    import pyarrow.parquet as pq
+except Exception:
+    pa = None
+    pq = None
+
+
+ANSWER_LABELS = ("Yes", "No", "No Evidence")
+QUALITY_LABELS = ("High", "Moderate", "Low", "Very Low", "Missing")
+DISC_LABELS = ("Yes", "No", "Missing")
+YES_NO_NOE = set(ANSWER_LABELS)
+QUALITY_SET = set(QUALITY_LABELS)
+DISC_SET = set(DISC_LABELS)
+# Label -> row/column of the fixed-size confusion matrices
+ANSWER_IDX = {v: i for i, v in enumerate(ANSWER_LABELS)}
+QUALITY_IDX = {v: i for i, v in enumerate(QUALITY_LABELS)}
+DISC_IDX = {v: i for i, v in enumerate(DISC_LABELS)}
+EXAMPLE_FIELDNAMES = (
+    "doi", "question", "gt_answer", "pred_answer", "gt_quality", "pred_quality",
+    "gt_discrepancy", "pred_discrepancy", "status", "error", "field", "citation_count",
+)
+# Low-cardinality columns stored dictionary-encoded in examples.parquet
+CATEGORICAL_FIELDS = {
+    "gt_answer", "pred_answer", "gt_quality", "pred_quality",
+    "gt_discrepancy", "pred_discrepancy", "status", "field",
+}
+
+
+def write_examples_parquet(path: Path, columns: dict) -> None:
+    fields = []
+    for name in EXAMPLE_FIELDNAMES:
+        if name in CATEGORICAL_FIELDS:
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+        elif name == "citation_count":
+            fields.append(pa.field(name, pa.float32()))
+        else:
+            fields.append(pa.field(name, pa.string()))
+    table = pa.Table.from_pydict(columns, schema=pa.schema(fields))
+    pq.write_table(table, path, compression="zstd")
 
 
 def normalize(s):
@@ -42,6 +81,8 @@ def main() -> None:
     parser.add_argument("--merged-jsonl", required=True, help="Merged GT+pred JSONL from batch_parse_outputs.py")
     parser.add_argument("--out-dir", required=True, help="Directory to write CSV summaries and plots")
     parser.add_argument("--plot", action="store_true", help="If set, write PNG plots (requires matplotlib)")
+    parser.add_argument("--parquet", action="store_true", help="Also write examples.parquet (requires pyarrow)")
+    parser.add_argument("--no-examples", action="store_true", help="Skip the per-example outputs; only summaries, confusion matrices and plots are written")
     parser.add_argument("--metadata-jsonl", required=False, help="Optional metadata JSONL: {doi, field?, citation_count?, publication_year?}")
     args = parser.parse_args()
 
@@ -54,42 +95,43 @@ def main() -> None:
     if args.metadata_jsonl:
         meta_path = Path(args.metadata_jsonl)
         if meta_path.exists():
-            with meta_path.open("r", encoding="utf-8") as mf:
-                for line in mf:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        item = json.loads(line)
-                    except Exception:
-                        continue
-                    d = item.get("doi")
-                    if not d:
-                        continue
-                    meta_by_doi[str(d)] = item
+            for _, item in iter_jsonl(meta_path):
+                d = item.get("doi")
+                if not d:
+                    continue
+                meta_by_doi[str(d)] = item
 
     # Counters
     total = 0
     status_counter = Counter()
-    answer_confusion = Counter()  # (gt, pred)
-    quality_confusion = Counter()  # (gt, pred)
-    disc_confusion = Counter()  # (gt, pred)
+    # [gt][pred] counts; the label sets are tiny and fixed, so a list matrix
+    # avoids hashing a (gt, pred) tuple per row
+    answer_confusion = [[0] * len(ANSWER_LABELS) for _ in ANSWER_LABELS]
+    quality_confusion = [[0] * len(QUALITY_LABELS) for _ in QUALITY_LABELS]
+    disc_confusion = [[0] * len(DISC_LABELS) for _ in DISC_LABELS]
     error_examples = defaultdict(list)
 
-    rows = []
     correct = 0
     field_counts = Counter()
     field_correct = Counter()
     citation_points = []  # (citation_count: float, correct: int)
-    with merged_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                item = json.loads(line)
-            except Exception:
-                continue
+    # Per-example rows go straight to the CSV as records are parsed
+    csv_path = out_dir / "examples.csv"
+    questions = set()
+    # Columns are only accumulated when a Parquet copy was asked for
+    columns = None
+    if args.parquet and not args.no_examples:
+        if pa is None:
+            print("pyarrow is not installed; skipping examples.parquet")
+        else:
+            columns = {name: [] for name in EXAMPLE_FIELDNAMES}
+    examples_cm = nullcontext() if args.no_examples else csv_path.open("w", newline="", encoding="utf-8")
+    with examples_cm as examples_file:
+        examples = None
+        if examples_file is not None:
+            examples = csv.writer(examples_file)
+            examples.writerow(EXAMPLE_FIELDNAMES)
+        for _, item in iter_jsonl(merged_path):
             total += 1
             status = normalize(item.get("status"))
             status_counter[status] += 1
@@ -103,15 +145,15 @@ def main() -> None:
             pd_d = normalize(item.get("model_discrepancy"))
 
             is_correct = 0
-            if gt_ans in YES_NO_NOE and pd_ans in YES_NO_NOE:
-                answer_confusion[(gt_ans, pd_ans)] += 1
+            if gt_ans in ANSWER_IDX and pd_ans in ANSWER_IDX:
+                answer_confusion[ANSWER_IDX[gt_ans]][ANSWER_IDX[pd_ans]] += 1
                 if gt_ans == pd_ans:
                     correct += 1
                     is_correct = 1
-            if gt_q in QUALITY_SET and pd_q in QUALITY_SET:
-                quality_confusion[(gt_q, pd_q)] += 1
-            if gt_d in DISC_SET and pd_d in DISC_SET:
-                disc_confusion[(gt_d, pd_d)] += 1
+            if gt_q in QUALITY_IDX and pd_q in QUALITY_IDX:
+                quality_confusion[QUALITY_IDX[gt_q]][QUALITY_IDX[pd_q]] += 1
+            if gt_d in DISC_IDX and pd_d in DISC_IDX:
+                disc_confusion[DISC_IDX[gt_d]][DISC_IDX[pd_d]] += 1
 
             if pd_ans not in YES_NO_NOE:
                 error_examples["invalid_answer"].append(item)
@@ -136,31 +178,30 @@ def main() -> None:
             if citation_count is not None:
                 citation_points.append((citation_count, is_correct))
 
-            rows.append({
-                "doi": doi,
-                "question": item.get("question"),
-                "gt_answer": gt_ans,
-                "pred_answer": pd_ans,
-                "gt_quality": gt_q,
-                "pred_quality": pd_q,
-                "gt_discrepancy": gt_d,
-                "pred_discrepancy": pd_d,
-                "status": status,
-                "error": normalize(item.get("error")),
-                "field": field,
-                "citation_count": citation_count,
-            })
-
-    # Write per-example CSV
-    csv_path = out_dir / "examples.csv"
-    with csv_path.open("w", newline="", encoding="utf-8") as w:
-        fieldnames = list(rows[0].keys()) if rows else [
-            "doi","question","gt_answer","pred_answer","gt_quality","pred_quality","gt_discrepancy","pred_discrepancy","status","error"
-        ]
-        writer = csv.DictWriter(w, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
+            questions.add(item.get("question"))
+            if examples is None:
+                continue
+            row = (
+                doi,
+                item.get("question"),
+                gt_ans,
+                pd_ans,
+                gt_q,
+                pd_q,
+                gt_d,
+                pd_d,
+                status,
+                normalize(item.get("error")),
+                field,
+                citation_count,
+            )
+            examples.writerow(row)
+            if columns is not None:
+                for values, value in zip(columns.values(), row):
+                    values.append(value)
+
+    if columns is not None:
+        write_examples_parquet(out_dir / "examples.parquet", columns)
 
     # Write status summary
     status_path = out_dir / "status_summary.csv"
@@ -171,28 +212,36 @@ def main() -> None:
             writer.writerow([k, v])
 
     # Write confusion matrices
-    def write_confusion(path: Path, counts: Counter):
+    def write_confusion(path: Path, labels: tuple, matrix: list):
+        cells = [
+            (labels[g], labels[p], cnt)
+            for g, row in enumerate(matrix)
+            for p, cnt in enumerate(row)
+            if cnt
+        ]
+        # Most frequent pairs first, as before
+        cells.sort(key=lambda c: c[2], reverse=True)
         with path.open("w", newline="", encoding="utf-8") as w:
             writer = csv.writer(w)
             writer.writerow(["gt", "pred", "count"])
-            for (gt, pd), cnt in counts.most_common():
-                writer.writerow([gt, pd, cnt])
+            writer.writerows(cells)
 
-    write_confusion(out_dir / "answer_confusion.csv", answer_confusion)
-    write_confusion(out_dir / "quality_confusion.csv", quality_confusion)
-    write_confusion(out_dir / "discrepancy_confusion.csv", disc_confusion)
+    write_confusion(out_dir / "answer_confusion.csv", ANSWER_LABELS, answer_confusion)
+    write_confusion(out_dir / "quality_confusion.csv", QUALITY_LABELS, quality_confusion)
+    write_confusion(out_dir / "discrepancy_confusion.csv", DISC_LABELS, disc_confusion)
 
     # Write a quick summary JSON
     summary = {
         "total": total,
         "status": dict(status_counter),
-        "unique_questions": len({r.get("question") for r in rows}),
+        "unique_questions": len(questions),
         "accuracy_answer": (correct / total) if total else None,
     }
     with (out_dir / "summary.json").open("w", encoding="utf-8") as w:
         json.dump(summary, w, indent=2)
 
-    print(f"Wrote: {csv_path}, {status_path}, confusion CSVs, and summary.json")
+    examples_note = "" if args.no_examples else f"{csv_path}, "
+    print(f"Wrote: {examples_note}{status_path}, confusion CSVs, and summary.json")
 
     # Optional plots
     if args.plot and plt is not None:
@@ -262,23 +311,44 @@ def main() -> None:
                     bins = sorted(set(float(x) for x in qs))
                 except Exception:
                     bins = None
-            if not bins:
+            if not bins or len(bins) < 2:
                 bins = [0, 5, 10, 50, 100, 500, 1000, float("inf")]
 
-            def bin_label(v: float) -> str:
-                for i in range(len(bins) - 1):
-                    lo, hi = bins[i], bins[i + 1]
-                    if v >= lo and v < hi:
-                        return f"[{int(lo)}-{('inf' if math.isinf(hi) else int(hi))})"
-                return f">={int(bins[-2])}"
+            labels = [
+                f"[{int(lo)}-{('inf' if math.isinf(hi) else int(hi))})" for lo, hi in zip(bins, bins[1:])
+            ]
+            overflow_label = f">={int(bins[-2])}"
 
             btot = Counter()
             bcor = Counter()
-            for v, y in citation_points:
-                b = bin_label(float(v))
-                btot[b] += 1
-                bcor[b] += int(y)
-            bkeys = sorted(btot.keys(), key=lambda k: (float(k.split('-')[0].strip('[') or 0)))
+            if np is not None:
+                # digitize gives i with bins[i-1] <= v < bins[i]; 0 and len(bins)
+                # are the out-of-range ends that bin_label reports as overflow
+                xs = np.fromiter((c for c, _ in citation_points), dtype=float, count=len(citation_points))
+                ys = np.fromiter((y for _, y in citation_points), dtype=float, count=len(citation_points))
+                idx = np.digitize(xs, bins)
+                totals = np.bincount(idx, minlength=len(bins) + 1)
+                corrects = np.bincount(idx, weights=ys, minlength=len(bins) + 1)
+                for i in np.flatnonzero(totals):
+                    b = labels[i - 1] if 1 <= i < len(bins) else overflow_label
+                    btot[b] += int(totals[i])
+                    bcor[b] += int(corrects[i])
+            else:
+                # Same bins via binary search; counts are kept per index and
+                # labelled once afterwards
+                tot_by_idx = Counter()
+                cor_by_idx = Counter()
+                for v, y in citation_points:
+                    i = bisect.bisect_right(bins, float(v)) - 1
+                    tot_by_idx[i] += 1
+                    cor_by_idx[i] += int(y)
+                for i, cnt in tot_by_idx.items():
+                    b = labels[i] if 0 <= i < len(labels) else overflow_label
+                    btot[b] += cnt
+                    bcor[b] += cor_by_idx[i]
+            # Labels are already in bin order; the overflow bin (e.g. the top
+            # quantile edge itself) goes last
+            bkeys = [k for k in dict.fromkeys(labels + [overflow_label]) if k in btot]
             with (out_dir / "citation_bin_accuracy.csv").open("w", newline="", encoding="utf-8") as w:
                 writer = csv.writer(w)
                 writer.writerow(["bin", "count", "accuracy"])
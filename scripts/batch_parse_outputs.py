@@ -5,27 +5,30 @@ ROOT_DIR = _P(__file__).resolve().parents[1]
 if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 import argparse
-import json
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    import json_repair  # optional, salvages malformed model JSON
+except Exception:
+    json_repair = None
+
+from medal.batch import response_text
+from medal.jsonio import dumps_line, iter_jsonl, loads
+from medal.schemas import Assessment
 
 
 def load_ground_truth_map(input_jsonl: Path) -> Tuple[Dict[str, dict], Dict[str, dict]]:
     by_id: Dict[str, dict] = {}
     by_doi: Dict[str, dict] = {}
-    with input_jsonl.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                item = json.loads(line)
-            except Exception:
-                continue
-            if "id" in item and item["id"]:
-                by_id[str(item["id"])]= item
-            if "doi" in item and item["doi"]:
-                by_doi[str(item["doi"])]= item
+    for _, item in iter_jsonl(input_jsonl):
+        if "id" in item and item["id"]:
+            by_id[str(item["id"])]= item
+        if "doi" in item and item["doi"]:
+            by_doi[str(item["doi"])]= item
     return by_id, by_doi
 
 
@@ -37,11 +40,132 @@ def parse_custom_id(custom_id: str) -> str:
 
 
 def extract_message_json(content_text: str) -> dict:
+    # Replies from structured-output runs validate in one typed pass; anything
+    # off-schema is still parsed below so invalid values stay visible downstream
+    try:
+        return Assessment.model_validate_json(content_text).model_dump(by_alias=True)
+    except Exception:
+        pass
     try:
-        return json.loads(content_text)
+        return loads(content_text)
     except Exception:
-        # Return as best-effort wrapper
-        return {"raw": content_text}
+        pass
+    # Only malformed replies (trailing commas, fences, truncation) reach the
+    # slower lenient parser, so well-formed output keeps the fast path
+    if json_repair is not None:
+        try:
+            data = json_repair.loads(content_text)
+            if isinstance(data, dict) and data:
+                return data
+        except Exception:
+            pass
+    # Return as best-effort wrapper
+    return {"raw": content_text}
+
+
+# default prediction structure, copied per line rather than rebuilt
+_PRED_TEMPLATE = {
+    "key": None,
+    "custom_id": None,
+    "status": None,
+    "error": None,
+    "model_answer": None,
+    "model_evidence-quality": None,
+    "model_discrepancy": None,
+    "model_notes": None,
+}
+
+
+def build_rows(obj: dict, by_id: Dict[str, dict], by_doi: Dict[str, dict]) -> Tuple[dict, Optional[dict]]:
+    """Normalise one batch result line; returns (prediction, merged GT+pred or None)."""
+    custom_id = obj.get("custom_id") or obj.get("id") or ""
+    key = parse_custom_id(custom_id)
+
+    pred = _PRED_TEMPLATE.copy()
+    pred["key"] = key
+    pred["custom_id"] = custom_id
+
+    if "error" in obj and obj["error"]:
+        pred["status"] = "error"
+        pred["error"] = obj["error"]
+    else:
+        resp = obj.get("response", {})
+        pred["status"] = f"{resp.get('status_code')}"
+        try:
+            content_text = response_text(obj)
+            data = extract_message_json(content_text) if content_text else {}
+            pred["model_answer"] = data.get("answer")
+            pred["model_evidence-quality"] = data.get("evidence-quality")
+            pred["model_discrepancy"] = data.get("discrepancy")
+            pred["model_notes"] = data.get("notes")
+        except Exception as e:
+            pred["error"] = f"parse_error: {e}"
+
+    # merge with ground truth if found
+    gt = by_id.get(key) or by_doi.get(key)
+    if not gt:
+        return pred, None
+    merged = {
+        "id": gt.get("id"),
+        "doi": gt.get("doi"),
+        "question": gt.get("question"),
+        "ground_truth_answer": gt.get("answer"),
+        "ground_truth_evidence-quality": gt.get("evidence-quality"),
+        "ground_truth_discrepancy": gt.get("discrepancy"),
+        "model_answer": pred.get("model_answer"),
+        "model_evidence-quality": pred.get("model_evidence-quality"),
+        "model_discrepancy": pred.get("model_discrepancy"),
+        "model_notes": pred.get("model_notes"),
+        "status": pred.get("status"),
+        "custom_id": pred.get("custom_id"),
+        "error": pred.get("error"),
+    }
+    return pred, merged
+
+
+# Size at which buffered output lines are written out in the single-process path
+FLUSH_BYTES = 1 << 20
+
+# Results are handed to worker processes in blocks of whole lines of about this size
+CHUNK_BYTES = 16 << 20
+
+# Ground-truth maps of a worker process, set once by _init_worker
+_GT_MAPS: Tuple[Dict[str, dict], Dict[str, dict]] = ({}, {})
+
+
+def _init_worker(by_id: Dict[str, dict], by_doi: Dict[str, dict]) -> None:
+    global _GT_MAPS
+    _GT_MAPS = (by_id, by_doi)
+
+
+def iter_line_chunks(path: Path, chunk_bytes: int = CHUNK_BYTES) -> Iterator[bytes]:
+    """Yield blocks of roughly `chunk_bytes` that always end on a line boundary."""
+    with path.open("rb") as f:
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                return
+            yield data + f.readline()
+
+
+def parse_results_chunk(chunk: bytes) -> Tuple[bytes, bytes]:
+    """Worker entry point: parse a block of result lines into (pred, merged) JSONL bytes."""
+    by_id, by_doi = _GT_MAPS
+    preds, merged_rows = [], []
+    # Bound once here instead of looked up again on every line
+    add_pred, add_merged, _loads, _dumps_line = preds.append, merged_rows.append, loads, dumps_line
+    for line in chunk.splitlines():
+        if not line.strip():
+            continue
+        try:
+            obj = _loads(line)
+        except Exception:
+            continue
+        pred, merged = build_rows(obj, by_id, by_doi)
+        add_pred(_dumps_line(pred))
+        if merged is not None:
+            add_merged(_dumps_line(merged))
+    return b"".join(preds), b"".join(merged_rows)
 
 
 def main() -> None:
@@ -50,6 +174,7 @@ def main() -> None:
     parser.add_argument("--batch-results-jsonl", required=True, help="Results JSONL downloaded from batch job")
     parser.add_argument("--out-pred-jsonl", required=True, help="Path to write normalized predictions JSONL")
     parser.add_argument("--out-merged-jsonl", required=True, help="Path to write merged GT+pred JSONL")
+    parser.add_argument("--workers", type=int, default=1, help="Parse result chunks in this many processes (output order is preserved)")
     args = parser.parse_args()
 
     input_path = Path(args.input_jsonl)
@@ -61,89 +186,47 @@ def main() -> None:
 
     by_id, by_doi = load_ground_truth_map(input_path)
 
-    with results_path.open("r", encoding="utf-8") as r, \
-         out_pred_path.open("w", encoding="utf-8") as wpred, \
-         out_merged_path.open("w", encoding="utf-8") as wmerge:
-
-        for line in r:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-            except Exception:
-                continue
-
-            custom_id = obj.get("custom_id") or obj.get("id") or ""
-            key = parse_custom_id(custom_id)
-
-            # default prediction structure
-            pred = {
-                "key": key,
-                "custom_id": custom_id,
-                "status": None,
-                "error": None,
-                "model_answer": None,
-                "model_evidence-quality": None,
-                "model_discrepancy": None,
-                "model_notes": None,
-            }
-
-            if "error" in obj and obj["error"]:
-                pred["status"] = "error"
-                pred["error"] = obj["error"]
-            else:
-                resp = obj.get("response", {})
-                pred["status"] = f"{resp.get('status_code')}"
-                body = resp.get("body", {})
-                try:
-                    content_text = ""
-                    if obj.get("url") == "/v1/responses" or body.get("id", "").startswith("resp_"):
-                        # Responses API shape
-                        output = body.get("output") or body.get("content") or []
-                        parts = []
-                        for item in output:
-                            for c in item.get("content", []):
-                                if "text" in c:
-                                    t = c["text"]
-                                    parts.append(t.get("value") if isinstance(t, dict) else str(t))
-                        content_text = "\n".join(parts)
-                    else:
-                        # Chat Completions
-                        content_text = body.get("choices", [{}])[0].get("message", {}).get("content", "")
-                    data = extract_message_json(content_text) if content_text else {}
-                    pred["model_answer"] = data.get("answer")
-                    pred["model_evidence-quality"] = data.get("evidence-quality")
-                    pred["model_discrepancy"] = data.get("discrepancy")
-                    pred["model_notes"] = data.get("notes")
-                except Exception as e:
-                    pred["error"] = f"parse_error: {e}"
-
-            # write prediction line
-            wpred.write(json.dumps(pred) + "\n")
-
-            # merge with ground truth if found
-            gt = by_id.get(key) or by_doi.get(key)
-            if gt:
-                merged = {
-                    "id": gt.get("id"),
-                    "doi": gt.get("doi"),
-                    "question": gt.get("question"),
-                    "ground_truth_answer": gt.get("answer"),
-                    "ground_truth_evidence-quality": gt.get("evidence-quality"),
-                    "ground_truth_discrepancy": gt.get("discrepancy"),
-                    "model_answer": pred.get("model_answer"),
-                    "model_evidence-quality": pred.get("model_evidence-quality"),
-                    "model_discrepancy": pred.get("model_discrepancy"),
-                    "model_notes": pred.get("model_notes"),
-                    "status": pred.get("status"),
-                    "custom_id": pred.get("custom_id"),
-                    "error": pred.get("error"),
-                }
-                wmerge.write(json.dumps(merged) + "\n")
+    with out_pred_path.open("wb") as wpred, \
+         out_merged_path.open("wb") as wmerge:
+
+        if args.workers > 1:
+            # Forked workers inherit the ground-truth maps instead of unpickling them
+            ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else None
+            with ProcessPoolExecutor(
+                max_workers=args.workers, mp_context=ctx, initializer=_init_worker, initargs=(by_id, by_doi)
+            ) as pool:
+                # Chunks are written back in submission order; at most 2 per
+                # worker are in flight so the file is never read in whole
+                pending: deque = deque()
+                for chunk in iter_line_chunks(results_path):
+                    pending.append(pool.submit(parse_results_chunk, chunk))
+                    if len(pending) >= args.workers * 2:
+                        pred_bytes, merged_bytes = pending.popleft().result()
+                        wpred.write(pred_bytes)
+                        wmerge.write(merged_bytes)
+                while pending:
+                    pred_bytes, merged_bytes = pending.popleft().result()
+                    wpred.write(pred_bytes)
+                    wmerge.write(merged_bytes)
+            return
+
+        # Output lines are collected in memory and written in ~1 MiB pieces
+        # rather than one write call per row
+        buf_pred, buf_merged, _dumps_line = bytearray(), bytearray(), dumps_line
+        # Lines are parsed straight from bytes, with no decode or strip copy
+        for _, obj in iter_jsonl(results_path):
+            pred, merged = build_rows(obj, by_id, by_doi)
+            buf_pred += _dumps_line(pred)
+            if merged is not None:
+                buf_merged += _dumps_line(merged)
+            if len(buf_pred) >= FLUSH_BYTES:
+                wpred.write(buf_pred)
+                wmerge.write(buf_merged)
+                buf_pred.clear()
+                buf_merged.clear()
+        wpred.write(buf_pred)
+        wmerge.write(buf_merged)
 
 
 if __name__ == "__main__":
     main()
-
-
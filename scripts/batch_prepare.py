@@ -5,11 +5,13 @@ ROOT_DIR = _P(__file__).resolve().parents[1]
 if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 import argparse
-import json
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
 from medal import load_dotenv_if_present
+from medal.batch import chat_batch_line
+from medal.evaluation import eval_request_body
+from medal.jsonio import dumps_line, iter_jsonl
 
 
 PROMPT_TEMPLATE = (
@@ -46,12 +48,44 @@ def safe_id(raw: Optional[str], fallback: str) -> str:
     return str(raw).strip().replace("\n", " ")
 
 
+def iter_batch_lines(in_path: Path, model: str, response_format_json: bool, eval_prompt: bool) -> Iterator[bytes]:
+    """Yield one encoded Batch API request line per input question."""
+    num = 0
+    # Blank and unparseable lines are skipped
+    for _, record in iter_jsonl(in_path):
+        qid = record.get("id")
+        doi = record.get("doi")
+        question = record.get("question", "").strip()
+        if not question:
+            continue
+
+        num += 1
+        identifier = safe_id(qid, safe_id(doi, f"row-{num}"))
+        custom_id = f"qid:{identifier}"
+
+        if eval_prompt:
+            body = eval_request_body(model, question)
+        else:
+            body = {
+                "model": model,
+                "messages": [{"role": "user", "content": PROMPT_TEMPLATE.format(question=question)}],
+            }
+            # Use Chat Completions for GPT-5 in batch; omit temperature/reasoning
+            if not str(model).startswith("gpt-5"):
+                body["temperature"] = 0.2
+            if response_format_json:
+                body["response_format"] = {"type": "json_object"}
+
+        yield dumps_line(chat_batch_line(custom_id, body))
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Prepare OpenAI Batch JSONL for chat completions")
     parser.add_argument("--input-jsonl", required=True, help="Path to input QAPair JSONL")
     parser.add_argument("--out-jsonl", required=True, help="Path to write batch input JSONL")
     parser.add_argument("--model", default="gpt-4o-mini", help="Target model (e.g., gpt-4o-mini, gpt-5)")
     parser.add_argument("--response-format-json", action="store_true", help="Request JSON response_format for stricter parsing")
+    parser.add_argument("--eval-prompt", action="store_true", help="Use the shared evaluate.py prompt (system prefix + question) so results match live runs")
     args = parser.parse_args()
 
     load_dotenv_if_present()
@@ -60,59 +94,9 @@ def main() -> None:
     out_path = Path(args.out_jsonl)
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
-    num = 0
-    with in_path.open("r", encoding="utf-8") as r, out_path.open("w", encoding="utf-8") as w:
-        for line in r:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                record = json.loads(line)
-            except Exception:
-                continue
-
-            qid = record.get("id")
-            doi = record.get("doi")
-            question = record.get("question", "").strip()
-            if not question:
-                continue
-
-            num += 1
-            identifier = safe_id(qid, safe_id(doi, f"row-{num}"))
-            custom_id = f"qid:{identifier}"
-
-            prompt = PROMPT_TEMPLATE.format(question=question)
-
-            if str(args.model).startswith("gpt-5"):
-                # Use Chat Completions for GPT-5 in batch; omit temperature/reasoning
-                body = {
-                    "model": args.model,
-                    "messages": [{"role": "user", "content": prompt}],
-                }
-                if args.response_format_json:
-                    body["response_format"] = {"type": "json_object"}
-                batch_line = {
-                    "custom_id": custom_id,
-                    "method": "POST",
-                    "url": "/v1/chat/completions",
-                    "body": body,
-                }
-            else:
-                body = {
-                    "model": args.model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.2,
-                }
-                if args.response_format_json:
-                    body["response_format"] = {"type": "json_object"}
-                batch_line = {
-                    "custom_id": custom_id,
-                    "method": "POST",
-                    "url": "/v1/chat/completions",
-                    "body": body,
-                }
-
-            w.write(json.dumps(batch_line) + "\n")
+    # One large buffer turns the per-line writes into a few big ones
+    with out_path.open("wb", buffering=1 << 20) as w:
+        w.writelines(iter_batch_lines(in_path, args.model, args.response_format_json, args.eval_prompt))
 
 
 if __name__ == "__main__":
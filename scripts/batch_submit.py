@@ -6,15 +6,10 @@ if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 import argparse
 import json
-import time
 from pathlib import Path
-from typing import Optional
 
 from medal import load_dotenv_if_present, require_env
-
-
-def human_status(s: str) -> str:
-    return s.replace("_", " ")
+from medal.batch import download_file, submit_batch, wait_for_batch
 
 
 def main() -> None:
@@ -36,33 +31,9 @@ def main() -> None:
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    # Detect endpoint from first JSONL line (defaults to chat completions)
-    detected_endpoint = "/v1/chat/completions"
-    try:
-        with input_path.open("r", encoding="utf-8") as rf:
-            for line in rf:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    first_obj = json.loads(line)
-                    detected_endpoint = first_obj.get("url", detected_endpoint)
-                except Exception:
-                    pass
-                break
-    except Exception:
-        pass
-
-    # Upload the file for batch processing
-    file_obj = client.files.create(file=input_path.open("rb"), purpose="batch")
-
-    # Create the batch job targeting the detected endpoint
-    batch = client.batches.create(
-        input_file_id=file_obj.id,
-        endpoint=detected_endpoint,
-        completion_window="24h",
-        display_name=args.display_name or f"MEDAL batch {input_path.name}",
-    )
+    # Upload the file and create the batch job; the endpoint is read from the
+    # first JSONL line (defaulting to chat completions) during the same open
+    batch, file_obj = submit_batch(client, input_path, endpoint=None, display_name=args.display_name)
 
     meta_path = out_dir / f"{batch.id}.json"
     with meta_path.open("w", encoding="utf-8") as w:
@@ -70,35 +41,20 @@ def main() -> None:
     print(f"Submitted batch: {batch.id}; input file: {file_obj.id}; metadata: {meta_path}")
 
     # Poll for completion
-    start = time.time()
-    while True:
-        b = client.batches.retrieve(batch.id)
-        status = b.status
-        print(f"Status: {human_status(status)} | succeeded={b.request_counts.completed} failed={b.request_counts.failed}")
-        if status in {"completed", "failed", "expired", "cancelling", "cancelled"}:
-            break
-        if time.time() - start > args.timeout_seconds:
-            print("Timeout reached; exiting.")
-            return
-        time.sleep(args.poll_seconds)
+    b = wait_for_batch(client, batch.id, poll_seconds=args.poll_seconds, timeout_seconds=args.timeout_seconds)
+    if b is None:
+        return
 
     # Download results if available
     if getattr(b, "output_file_id", None):
-        out_file = client.files.retrieve(b.output_file_id)
-        content = client.files.content(b.output_file_id)
-        out_path = out_dir / f"{batch.id}.results.jsonl"
-        with out_path.open("wb") as w:
-            w.write(content.read())
+        out_path = download_file(client, b.output_file_id, out_dir / f"{batch.id}.results.jsonl")
         print(f"Saved results to: {out_path}")
     else:
         print("No output_file_id on batch; check status and errors.")
 
     # Save error file if present
     if getattr(b, "error_file_id", None):
-        err_content = client.files.content(b.error_file_id)
-        err_path = out_dir / f"{batch.id}.errors.jsonl"
-        with err_path.open("wb") as w:
-            w.write(err_content.read())
+        err_path = download_file(client, b.error_file_id, out_dir / f"{batch.id}.errors.jsonl")
         print(f"Saved errors to: {err_path}")
 
 
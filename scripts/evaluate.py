@@ -1,21 +1,76 @@
 #!/usr/bin/env python
 import argparse
 import asyncio
-import json
 from pathlib import Path
+from typing import List, Optional
 
 from medal import load_dotenv_if_present, require_env
-from medal.clients import make_openai_async_client, bounded_json_chat_completion
+from medal.batch import chat_batch_line, run_batch_job
+from medal.clients import (
+    bounded_json_chat_completion,
+    bounded_json_chat_completion_multi,
+    chunked,
+    make_openai_async_client,
+    resolve_grouped,
+    run_async,
+    run_worker_pool,
+)
+from medal.evaluation import (
+    EVAL_PROMPT,
+    QUESTION_TEMPLATE,
+    error_response,
+    eval_request_body,
+    is_error_row,
+    load_checkpoint,
+    make_row,
+)
+from medal.jsonio import dumps_line, has_torn_tail, iter_jsonl, loads, write_json
+from medal.llm_cache import open_cache_from_env
+from medal.ratelimit import RequestTokenLimiter
+from medal.schemas import ASSESSMENT_JSON_SCHEMA
 
 
-EVAL_PROMPT = """
-You are a clinical research expert with knowledge of systematic reviews, RCTs, and observational studies.
-Task: Given a clinical question, return a JSON with keys question, answer, evidence-quality, discrepancy, notes.
-Allowed values:
-- answer: Yes | No | No Evidence
-- evidence-quality: High | Moderate | Low | Very Low | Missing
-- discrepancy: Yes | No | Missing
-""".strip()
+
+def run_batch(
+    api_key: str,
+    model: str,
+    records: list,
+    out_path: Path,
+    poll_seconds: int,
+    json_schema: Optional[dict] = None,
+) -> dict:
+    """Evaluate every record through the OpenAI Batch API (half price, no RPM cap)."""
+    from openai import OpenAI
+
+    client = OpenAI(api_key=api_key)
+    input_path = out_path.with_name(f"{out_path.stem}.batch_input.jsonl")
+    # One request per distinct question; rows sharing it reuse the response
+    first_idx = {}
+    with input_path.open("wb") as w:
+        for idx, item in records:
+            if item["question"] in first_idx:
+                continue
+            first_idx[item["question"]] = idx
+            body = eval_request_body(model, item["question"], json_schema)
+            w.write(dumps_line(chat_batch_line(f"idx:{idx}", body)))
+
+    replies = run_batch_job(
+        client,
+        input_path,
+        out_path.with_name(f"{out_path.stem}.batch_results.jsonl"),
+        display_name=f"MEDAL evaluate {out_path.stem}",
+        poll_seconds=poll_seconds,
+    )
+    responses = {
+        custom_id.split(":", 1)[-1]: error_response("", reply) if isinstance(reply, Exception) else reply
+        for custom_id, reply in replies.items()
+    }
+
+    out = {}
+    for idx, item in records:
+        resp = responses.get(first_idx[item["question"]]) or error_response(item["question"], "missing from batch output")
+        out[idx] = make_row(item, resp)
+    return out
 
 
 async def main() -> None:
@@ -24,63 +79,123 @@ async def main() -> None:
     parser.add_argument("--out-json", required=True)
     parser.add_argument("--model", default="gpt-4o")
     parser.add_argument("--max-concurrent", type=int, default=5)
+    parser.add_argument("--max-rpm", type=float, default=None, help="Optional requests-per-minute cap; set a few percent below your account limit")
+    parser.add_argument("--max-tpm", type=float, default=None, help="Optional tokens-per-minute cap; calls are charged an estimate up front and corrected to reported usage")
+    parser.add_argument("--batch", "--offline", dest="batch", action="store_true", help="Submit all questions as one OpenAI Batch job (50%% cheaper, results within 24h)")
+    parser.add_argument("--strict-schema", action="store_true", help="Use strict structured outputs (JSON schema) instead of JSON mode; needs a model that supports them")
+    parser.add_argument("--poll-seconds", type=int, default=30, help="Batch status polling interval")
+    parser.add_argument("--questions-per-call", type=int, default=1, help="Pack up to this many questions into one request under a single EVAL_PROMPT (1 = one request per question)")
     args = parser.parse_args()
 
     load_dotenv_if_present()
     api_key = require_env("OPENAI_API_KEY")
-    client = make_openai_async_client(api_key)
-    semaphore = asyncio.Semaphore(args.max_concurrent)
-
-    records = []
-    with open(args.input_jsonl, "r", encoding="utf-8") as f:
-        for i, line in enumerate(f):
-            try:
-                item = json.loads(line)
-                records.append((str(i), item))
-            except Exception:
-                pass
-
-    async def evaluate_one(idx: str, item: dict):
-        q = item["question"]
-        prompt = f"{EVAL_PROMPT}\n\nQuestion:\n\"\"\"{q}\"\"\""
-        try:
-            content = await bounded_json_chat_completion(client, args.model, prompt, semaphore, temperature=0.2)
-            resp = json.loads(content)
-        except Exception as e:
-            resp = {
-                "question": q,
-                "answer": "ERROR",
-                "evidence-quality": "ERROR",
-                "discrepancy": "ERROR",
-                "notes": str(e),
-            }
-        return {
-            idx: {
-                "doi": item.get("doi", ""),
-                "question": q,
-                "model_answer": resp.get("answer", ""),
-                "model_evidence-quality": resp.get("evidence-quality", ""),
-                "model_discrepancy": resp.get("discrepancy", ""),
-                "model_notes": resp.get("notes", ""),
-                "ground_truth_answer": item.get("answer", ""),
-                "ground_truth_evidence-quality": item.get("evidence-quality", ""),
-                "ground_truth_discrepancy": item.get("discrepancy", ""),
-            }
-        }
-
-    tasks = [evaluate_one(idx, item) for idx, item in records]
-    out = {}
-    for coro in asyncio.as_completed(tasks):
-        out.update(await coro)
 
     out_path = Path(args.out_json)
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", encoding="utf-8") as w:
-        json.dump(out, w, indent=2)
+    json_schema = ASSESSMENT_JSON_SCHEMA if args.strict_schema else None
+    if args.batch:
+        records = [(str(i), item) for i, item in iter_jsonl(args.input_jsonl)]
+        out = await asyncio.to_thread(
+            run_batch, api_key, args.model, records, out_path, args.poll_seconds, json_schema
+        )
+        await asyncio.to_thread(write_json, out_path, out)
+        return
+
+    client = make_openai_async_client(api_key, max_connections=args.max_concurrent)
+    cache = open_cache_from_env()
+    limiter = RequestTokenLimiter(args.max_rpm, args.max_tpm) if args.max_rpm or args.max_tpm else None
+
+    # Completed rows are appended to a partial JSONL as they finish, so a crash
+    # loses nothing and a re-run resumes from what is already on disk
+    partial_path = out_path.with_name(f"{out_path.stem}.partial.jsonl")
+    out = {}
+    torn = False
+    if partial_path.exists():
+        out = load_checkpoint(partial_path)
+        torn = has_torn_tail(partial_path)
+        print(f"Resuming: {len(out)} rows already in {partial_path}")
+
+    # Records are parsed lazily as workers pull them rather than loaded up front
+    done = set(out)
+    records = (
+        (str(i), item) for i, item in iter_jsonl(args.input_jsonl) if str(i) not in done
+    )
+
+    async def ask(q: str) -> dict:
+        try:
+            content = await bounded_json_chat_completion(
+                client,
+                args.model,
+                QUESTION_TEMPLATE.format(question=q),
+                semaphore=None,
+                temperature=0.2,
+                cache=cache,
+                limiter=limiter,
+                system_prompt=EVAL_PROMPT,
+                json_schema=json_schema,
+            )
+            return loads(content)
+        except Exception as e:
+            return error_response(q, e)
+
+    async def ask_many(questions: List[str]) -> List[Optional[dict]]:
+        """Answer several new questions with one request; None for any the reply misses."""
+        return await bounded_json_chat_completion_multi(
+            client,
+            args.model,
+            [QUESTION_TEMPLATE.format(question=q) for q in questions],
+            semaphore=None,
+            temperature=0.2,
+            limiter=limiter,
+            system_prompt=EVAL_PROMPT,
+        )
+
+    # The same question text recurs across DOIs; each distinct question is asked
+    # once and every row that shares it awaits the same task
+    responses = {}
+
+    def record_row(idx: str, item: dict, resp: dict) -> None:
+        row = make_row(item, resp)
+        out[idx] = row
+        if not is_error_row(row):
+            partial.write(dumps_line({idx: row}))
+
+    async def evaluate_one(record: tuple) -> None:
+        idx, item = record
+        q = item["question"]
+        if q not in responses:
+            responses[q] = asyncio.ensure_future(ask(q))
+        record_row(idx, item, await responses[q])
+
+    async def evaluate_group(group: list) -> None:
+        await resolve_grouped((item["question"] for _, item in group), responses, ask_many, ask)
+        for idx, item in group:
+            record_row(idx, item, await responses[item["question"]])
+
+    try:
+        with partial_path.open("ab", buffering=0) as partial:
+            if torn:
+                # Start after a torn final line rather than appending to it
+                partial.write(b"\n")
+            if args.questions_per_call > 1:
+                # Grouped calls share one copy of EVAL_PROMPT and use JSON mode;
+                # questions missing from a reply fall back to single calls
+                groups = chunked(records, args.questions_per_call)
+                await run_worker_pool(groups, evaluate_group, args.max_concurrent)
+            else:
+                await run_worker_pool(records, evaluate_one, args.max_concurrent)
+    finally:
+        await client.close()
+    if cache is not None:
+        cache.close()
+
+    # Serialising a large result dict is CPU-bound; keep it off the event loop
+    await asyncio.to_thread(write_json, out_path, out)
+    partial_path.unlink()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())
 
 
 
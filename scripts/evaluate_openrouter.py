@@ -3,71 +3,211 @@
 Evaluate clinical QA dataset using OpenRouter API.
 Supports Claude Sonnet 4.5, DeepSeek, and other models via OpenRouter.
 """
+import sys
+from pathlib import Path as _P
+ROOT_DIR = _P(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
 import argparse
 import asyncio
-import json
 import os
+import re
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Union
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, BadRequestError
 from tqdm import tqdm
 
-
-EVAL_PROMPT = """
-You are a clinical research expert with knowledge of systematic reviews, RCTs, and observational studies.
-Task: Given a clinical question, return a JSON with keys question, answer, evidence-quality, discrepancy, notes.
-Allowed values:
-- answer: Yes | No | No Evidence
-- evidence-quality: High | Moderate | Low | Very Low | Missing
-- discrepancy: Yes | No | Missing
-""".strip()
-
-
-def make_openrouter_client(api_key: str) -> AsyncOpenAI:
-    """Create OpenRouter client using OpenAI SDK."""
-    return AsyncOpenAI(
-        api_key=api_key,
+from medal import load_dotenv_if_present, require_env
+from medal.clients import (
+    COMPLETION_TOKENS_ESTIMATE,
+    build_multi_item_prompt,
+    call_with_retries,
+    chunked,
+    json_response_format,
+    make_openai_async_client,
+    resolve_grouped,
+    run_async,
+    run_worker_pool,
+    split_multi_item_reply,
+)
+from medal.evaluation import EVAL_PROMPT, QUESTION_TEMPLATE, error_response, is_error_row, load_checkpoint, make_row
+from medal.jsonio import dumps_line, has_torn_tail, is_valid_json, iter_jsonl, loads, write_json
+from medal.llm_cache import LLMCache, cache_key, open_cache_from_env
+from medal.ratelimit import AsyncRateLimiter, RequestTokenLimiter, estimate_tokens
+from medal.schemas import ASSESSMENT_JSON_SCHEMA
+
+
+JSON_INSTRUCTION = "You must respond with valid JSON only."
+
+# Strongest first; fence/prose stripping still covers replies sent without one
+RESPONSE_FORMATS = ["json_schema", "json_object", "none"]
+
+_CODE_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def extract_json_text(content: Optional[str]) -> Optional[str]:
+    """Strip markdown fences or surrounding prose from a reply, leaving the JSON object."""
+    if not content:
+        return content
+    stripped = content.strip()
+    # Most replies are already bare JSON; skip the regexes for those
+    if stripped[:1] == "{" and stripped[-1:] == "}":
+        return stripped
+    match = _CODE_FENCE_RE.search(stripped)
+    if match:
+        return match.group(1)
+    match = _JSON_OBJECT_RE.search(stripped)
+    return match.group(0) if match else content
+
+
+def response_format_ladder(start: str) -> List[Optional[dict]]:
+    """response_format values to try, from `start` down to none at all."""
+    ladder = [json_response_format(ASSESSMENT_JSON_SCHEMA), json_response_format(), None]
+    return ladder[RESPONSE_FORMATS.index(start):]
+
+
+def rejects_response_format(exc: BadRequestError) -> bool:
+    """Whether a 400 says response_format / structured outputs are unsupported."""
+    text = f"{exc.message} {exc.body}".lower()
+    return any(k in text for k in ("response_format", "json_schema", "json_object", "structured output"))
+
+
+def make_openrouter_client(api_key: str, max_connections: int = 15) -> AsyncOpenAI:
+    """Create OpenRouter client using OpenAI SDK.
+
+    Uses the shared pooled transport from medal.clients, so connections are kept
+    alive and reused, and requests share one connection over HTTP/2 when `h2`
+    is installed.
+    """
+    return make_openai_async_client(
+        api_key,
+        max_connections=max_connections,
         base_url="https://openrouter.ai/api/v1",
         default_headers={
             "HTTP-Referer": os.getenv("OPENROUTER_HTTP_REFERER", "https://github.com"),
             "X-Title": os.getenv("OPENROUTER_X_TITLE", "MEDAL Evaluation"),
-        }
+        },
+        read_timeout=120.0,
     )
 
 
+def assessment_tool(json_schema: dict) -> dict:
+    """Function tool whose arguments are the assessment; forcing it makes replies schema-valid JSON."""
+    return {
+        "type": "function",
+        "function": {
+            "name": "submit_assessment",
+            "description": "Submit the structured assessment of the clinical question.",
+            "parameters": json_schema,
+        },
+    }
+
+
+def build_messages(model: str, prompt: str, system_prompt: Optional[str] = None) -> list:
+    """Build chat messages with the static instructions as a cacheable system prefix."""
+    if not system_prompt:
+        return [{"role": "user", "content": f"{prompt}\n\n{JSON_INSTRUCTION}"}]
+    system_text = f"{system_prompt}\n\n{JSON_INSTRUCTION}"
+    if model.startswith("anthropic/"):
+        # Anthropic only caches blocks explicitly marked with cache_control
+        system_content = [
+            {"type": "text", "text": system_text, "cache_control": {"type": "ephemeral"}}
+        ]
+    else:
+        # OpenAI-style providers cache identical prefixes automatically
+        system_content = system_text
+    return [
+        {"role": "system", "content": system_content},
+        {"role": "user", "content": prompt},
+    ]
+
+
 async def bounded_json_chat_completion(
     client: AsyncOpenAI,
     model: str,
     prompt: str,
-    semaphore: asyncio.Semaphore,
+    semaphore: Optional[asyncio.Semaphore],
     temperature: Optional[float] = 0.2,
+    cache: Optional[LLMCache] = None,
+    limiter: Optional[Union[AsyncRateLimiter, RequestTokenLimiter]] = None,
+    system_prompt: Optional[str] = None,
+    json_schema: Optional[dict] = None,
+    response_formats: Optional[List[Optional[dict]]] = None,
 ) -> str:
-    """Call OpenRouter chat completion with rate limiting."""
-    async with semaphore:
-        try:
-            # Add explicit JSON instruction to prompt
-            json_prompt = f"{prompt}\n\nYou must respond with valid JSON only."
-
-            completion = await client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": json_prompt}],
-                temperature=temperature,
-            )
-            content = completion.choices[0].message.content
-
-            # Try to extract JSON if wrapped in markdown code blocks
-            if content and "```json" in content:
-                import re
-                json_match = re.search(r'```json\s*(\{.*?\})\s*```', content, re.DOTALL)
-                if json_match:
-                    content = json_match.group(1)
-            elif content and "```" in content:
-                import re
-                json_match = re.search(r'```\s*(\{.*?\})\s*```', content, re.DOTALL)
-                if json_match:
-                    content = json_match.group(1)
+    """Call OpenRouter chat completion with rate limiting.
+
+    With `json_schema`, the model is forced to call a tool taking that schema and
+    the tool arguments are returned, so no fence/prose stripping is needed.
+    Otherwise `response_formats[0]` is sent as response_format. If the provider
+    rejects it (an HTTP 400 naming response_format or structured outputs), it is
+    dropped from the shared list, so this and every later call fall back to the
+    next entry. Other 400s are raised without touching the list.
+    """
+    tools = {}
+    if json_schema is not None:
+        tool = assessment_tool(json_schema)
+        tools = {
+            "tools": [tool],
+            "tool_choice": {"type": "function", "function": {"name": tool["function"]["name"]}},
+        }
 
+    def key_for(response_format: Optional[dict]) -> str:
+        # Replies under different response_formats differ, so each gets its own entry
+        return cache_key(
+            model, prompt, temperature, system_prompt=system_prompt, json_schema=json_schema, response_format=response_format
+        )
+
+    if cache is not None:
+        cached = cache.get(key_for(response_formats[0] if response_formats and not tools else None))
+        if cached is not None:
+            return cached
+    messages = build_messages(model, prompt, system_prompt)
+    tokens = 0
+    if isinstance(limiter, RequestTokenLimiter):
+        tokens = estimate_tokens((system_prompt or "") + prompt) + COMPLETION_TOKENS_ESTIMATE
+    async with semaphore if semaphore is not None else nullcontext():
+        try:
+            while True:
+                response_format = response_formats[0] if response_formats and not tools else None
+                extra = {"response_format": response_format} if response_format else {}
+                try:
+                    # Transient 429/5xx/timeouts are retried here rather than becoming ERROR rows
+                    completion = await call_with_retries(
+                        lambda: client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            temperature=temperature,
+                            **tools,
+                            **extra,
+                        ),
+                        limiter,
+                        tokens=tokens,
+                    )
+                    break
+                except BadRequestError as e:
+                    # Only a rejected response_format moves the shared ladder down;
+                    # any other 400 (context length, model id, ...) is this call's own
+                    if response_format is None or not rejects_response_format(e):
+                        raise
+                    if response_formats[0] is response_format:
+                        print(f"Provider rejected response_format {response_format['type']}; falling back")
+                        response_formats.pop(0)
+            actual = getattr(getattr(completion, "usage", None), "total_tokens", None)
+            if tokens and actual:
+                limiter.reconcile(tokens, actual)
+            message = completion.choices[0].message
+            if message.tool_calls:
+                content = message.tool_calls[0].function.arguments
+            else:
+                content = extract_json_text(message.content)
+
+            # Only replies that parse are cached; a bad one is retried next run
+            if cache is not None and content and is_valid_json(content):
+                # Keyed by the format actually sent, which a fallback may have changed
+                cache.set(key_for(response_format), content)
             return content
         except Exception as e:
             print(f"Error in API call: {e}")
@@ -84,114 +224,163 @@ async def main() -> None:
         help="OpenRouter model ID (e.g., anthropic/claude-sonnet-4.5, deepseek/deepseek-chat)"
     )
     parser.add_argument("--max-concurrent", type=int, default=15, help="Max concurrent requests")
+    parser.add_argument("--max-rpm", type=float, default=None, help="Optional requests-per-minute cap; set a few percent below the provider limit")
+    parser.add_argument("--max-tpm", type=float, default=None, help="Optional tokens-per-minute cap; calls are charged an estimate up front and corrected to reported usage")
+    parser.add_argument("--strict-schema", action="store_true", help="Force a tool call with a typed schema instead of prompt-level JSON instructions")
+    parser.add_argument(
+        "--response-format",
+        choices=RESPONSE_FORMATS,
+        default="none",
+        help="Structured output to request (default: none, prompt-only JSON; ignored with --strict-schema); a provider that rejects it falls back to the next, ending with prompt-only JSON",
+    )
     parser.add_argument("--limit", type=int, help="Limit number of questions to evaluate (for testing)")
+    parser.add_argument("--questions-per-call", type=int, default=1, help="Pack up to this many questions into one request under a single EVAL_PROMPT (1 = one request per question)")
     args = parser.parse_args()
 
-    # Get API key from environment
-    api_key = os.getenv("OPENROUTER_API_KEY")
-    if not api_key:
-        raise ValueError("OPENROUTER_API_KEY environment variable not set")
+    load_dotenv_if_present()
+    api_key = require_env("OPENROUTER_API_KEY")
+    json_schema = ASSESSMENT_JSON_SCHEMA if args.strict_schema else None
+    # Shared by every call, so one rejected format is only tried once per run
+    response_formats = response_format_ladder(args.response_format)
+    multi_response_formats = response_format_ladder("json_object" if args.response_format != "none" else "none")
 
-    client = make_openrouter_client(api_key)
-    semaphore = asyncio.Semaphore(args.max_concurrent)
+    client = make_openrouter_client(api_key, max_connections=args.max_concurrent)
+    cache = open_cache_from_env()
+    limiter = RequestTokenLimiter(args.max_rpm, args.max_tpm) if args.max_rpm or args.max_tpm else None
 
-    # Load questions
-    records = []
-    with open(args.input_jsonl, "r", encoding="utf-8") as f:
-        for i, line in enumerate(f):
-            if args.limit and i >= args.limit:
-                break
-            try:
-                item = json.loads(line)
-                records.append((str(i), item))
-            except Exception as e:
-                print(f"Error parsing line {i}: {e}")
-                pass
-
-    print(f"Loaded {len(records)} questions")
+    def report_bad_line(i: int, e: Exception) -> None:
+        print(f"Error parsing line {i}: {e}")
+
+    # Count lines for the progress bar without parsing them; records are
+    # parsed lazily as workers pull them rather than loaded up front
+    with open(args.input_jsonl, "rb") as f:
+        num_lines = sum(1 for line in f if line.strip())
+    if args.limit:
+        num_lines = min(num_lines, args.limit)
+
+    print(f"Found {num_lines} questions")
     print(f"Using model: {args.model}")
     print(f"Max concurrent: {args.max_concurrent}")
 
     # Load checkpoint if exists
     out_path = Path(args.out_json)
-    checkpoint_path = out_path.parent / f"{out_path.stem}.checkpoint.json"
-    completed_indices = set()
+    # One {idx: row} line is appended per completed question, so checkpointing
+    # costs the same per row however far the run has got
+    checkpoint_path = out_path.parent / f"{out_path.stem}.checkpoint.jsonl"
     out = {}
+    torn = False
 
     if checkpoint_path.exists():
         print(f"Loading checkpoint from {checkpoint_path}")
-        with checkpoint_path.open("r", encoding="utf-8") as f:
-            out = json.load(f)
-            completed_indices = set(out.keys())
-        print(f"Resuming from checkpoint: {len(completed_indices)} already completed")
+        out = load_checkpoint(checkpoint_path)
+        torn = has_torn_tail(checkpoint_path)
+        print(f"Resuming from checkpoint: {len(out)} already completed")
+    completed_indices = set(out)
 
-    # Filter out already completed items
-    records_to_process = [(idx, item) for idx, item in records if idx not in completed_indices]
-    print(f"Processing {len(records_to_process)} questions ({len(completed_indices)} already completed)")
+    def iter_records():
+        for i, item in iter_jsonl(args.input_jsonl, on_error=report_bad_line):
+            if args.limit and i >= args.limit:
+                break
+            # Skip already completed items
+            if str(i) not in completed_indices:
+                yield str(i), item
 
-    async def evaluate_one(idx: str, item: dict, pbar: tqdm):
-        q = item["question"]
-        prompt = f"{EVAL_PROMPT}\n\nQuestion:\n\"\"\"{q}\"\"\""
+    print(f"Processing {num_lines - len(completed_indices)} questions ({len(completed_indices)} already completed)")
+
+    async def ask(q: str) -> dict:
         try:
             content = await bounded_json_chat_completion(
-                client, args.model, prompt, semaphore, temperature=0.2
+                client,
+                args.model,
+                QUESTION_TEMPLATE.format(question=q),
+                semaphore=None,
+                temperature=0.2,
+                cache=cache,
+                limiter=limiter,
+                system_prompt=EVAL_PROMPT,
+                json_schema=json_schema,
+                response_formats=response_formats,
             )
-            resp = json.loads(content)
+            return loads(content)
         except Exception as e:
-            resp = {
-                "question": q,
-                "answer": "ERROR",
-                "evidence-quality": "ERROR",
-                "discrepancy": "ERROR",
-                "notes": str(e),
-            }
-
-        result = {
-            idx: {
-                "doi": item.get("doi", ""),
-                "question": q,
-                "model_answer": resp.get("answer", ""),
-                "model_evidence-quality": resp.get("evidence-quality", ""),
-                "model_discrepancy": resp.get("discrepancy", ""),
-                "model_notes": resp.get("notes", ""),
-                "ground_truth_answer": item.get("answer", ""),
-                "ground_truth_evidence-quality": item.get("evidence-quality", ""),
-                "ground_truth_discrepancy": item.get("discrepancy", ""),
-            }
-        }
+            return error_response(q, e)
+
+    async def ask_many(questions: List[str]) -> List[Optional[dict]]:
+        """Answer several new questions with one request; None for any the reply misses."""
+        content = await bounded_json_chat_completion(
+            client,
+            args.model,
+            build_multi_item_prompt([QUESTION_TEMPLATE.format(question=q) for q in questions]),
+            semaphore=None,
+            temperature=0.2,
+            # Not cached, as in evaluate.py: the key would cover the whole
+            # group, which rarely recurs; questions re-asked alone are cached
+            limiter=limiter,
+            system_prompt=EVAL_PROMPT,
+            response_formats=multi_response_formats,
+        )
+        return split_multi_item_reply(content, len(questions))
+
+    # The same question text recurs across DOIs; each distinct question is asked
+    # once and every row that shares it awaits the same task
+    responses = {}
+
+    async def evaluate_one(idx: str, item: dict, pbar: tqdm):
+        q = item["question"]
+        if q not in responses:
+            responses[q] = asyncio.ensure_future(ask(q))
+        resp = await responses[q]
 
         pbar.update(1)
-        return result
-
-    # Run evaluations with progress bar and checkpointing
-    tasks = []
-    checkpoint_counter = 0
-    checkpoint_frequency = 50  # Save checkpoint every 50 completions
-
-    with tqdm(
-        total=len(records),
-        initial=len(completed_indices),
-        desc=f"Evaluating with {args.model}",
-        unit="question"
-    ) as pbar:
-        tasks = [evaluate_one(idx, item, pbar) for idx, item in records_to_process]
-
-        for coro in asyncio.as_completed(tasks):
-            result = await coro
-            out.update(result)
-            checkpoint_counter += 1
-
-            # Save checkpoint periodically
-            if checkpoint_counter >= checkpoint_frequency:
-                out_path.parent.mkdir(parents=True, exist_ok=True)
-                with checkpoint_path.open("w", encoding="utf-8") as w:
-                    json.dump(out, w, indent=2)
-                checkpoint_counter = 0
+        return {idx: make_row(item, resp)}
+
+    def record(result: dict) -> None:
+        out.update(result)
+        # Only successful rows are checkpointed, matching evaluate.py
+        persisted = {idx: row for idx, row in result.items() if not is_error_row(row)}
+        if persisted:
+            checkpoint.write(dumps_line(persisted))
+
+    async def process(item: tuple) -> None:
+        record(await evaluate_one(*item, pbar))
+
+    async def process_group(group: list) -> None:
+        await resolve_grouped((item["question"] for _, item in group), responses, ask_many, ask)
+        for idx, item in group:
+            # Every question is resolved by now, so this only builds the row
+            record(await evaluate_one(idx, item, pbar))
 
-    # Save final results
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", encoding="utf-8") as w:
-        json.dump(out, w, indent=2)
+    try:
+        with checkpoint_path.open("ab", buffering=0) as checkpoint, tqdm(
+            total=num_lines,
+            initial=len(completed_indices),
+            desc=f"Evaluating with {args.model}",
+            unit="question",
+            # Redraw at most twice a second / every 0.5% so updates stay cheap
+            mininterval=0.5,
+            miniters=max(1, num_lines // 200),
+        ) as pbar:
+            if torn:
+                # Start after a torn final line rather than appending to it
+                checkpoint.write(b"\n")
+            # A fixed pool of workers pulls from a bounded queue, so only
+            # max_concurrent requests are materialised at any time
+            if args.questions_per_call > 1:
+                # Grouped calls share one copy of EVAL_PROMPT and skip the
+                # strict tool schema; questions missing from a reply are re-asked alone
+                groups = chunked(iter_records(), args.questions_per_call)
+                await run_worker_pool(groups, process_group, args.max_concurrent)
+            else:
+                await run_worker_pool(iter_records(), process, args.max_concurrent)
+    finally:
+        await client.close()
+
+    if cache is not None:
+        cache.close()
+
+    # Save final results
+    await asyncio.to_thread(write_json, out_path, out)
 
     # Remove checkpoint file on successful completion
     if checkpoint_path.exists():
@@ -214,4 +403,4 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())
@@ -1,71 +1,143 @@
+import argparse
 import fitz  # PyMuPDF
 import re
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
+# Compiled once here; the scan below tries them on every line of every page
+COR_RE = re.compile(r"^(1|2a|2b|3(?::\s*(?:no benefit|harm))?)\b")
+LOE_RE = re.compile(r"^[A-C](?:-[A-Z]{1,2})?$")
+NUM_RE = re.compile(r"^\d+\.\s+")
+COR_START_RE = re.compile(r"^(1|2a|2b|3(?::.*)?)\b")
+CAP_SENT_RE = re.compile(r"^[A-Z][^a-z]*[a-z]+")
 
-def extract_strict_recommendation_blocks(pdf_path):
-    doc = fitz.open(pdf_path)
+
+def scan_page_text(text, page_num):
+    """Recommendation rows (COR, LOE, text) found in one page's extracted text."""
     tables = []
+    if "COR" not in text or "LOE" not in text:
+        return tables
+
+    # Lines are stripped and lower-cased once per page, not on every visit
+    lines = [ln for ln in (raw.strip() for raw in text.split("\n")) if ln]
+    lower_lines = [ln.lower() for ln in lines]
+    i = 0
 
-    for page_num, page in enumerate(doc):
-        text = page.get_text()
-        if "COR" not in text or "LOE" not in text:
+    while i < len(lines) - 2:
+        cor_line = lower_lines[i]
+        # Almost every line fails here, before any regex is run
+        if cor_line[0] not in "123":
+            i += 1
             continue
 
-        lines = [ln.strip() for ln in text.split("\n") if ln.strip()]
-        i = 0
-
-        while i < len(lines) - 2:
-            cor_line = lines[i].strip().lower()
-
-            if cor_line.startswith("3: no") and i + 1 < len(lines):
-                next_line = lines[i + 1].strip().lower()
-                if "benefit" in next_line:
-                    cor_line = "3: no benefit"
-                    i += 1
-
-            cor_m = re.match(r"^(1|2a|2b|3(?::\s*(no benefit|harm))?)\b", cor_line)
-            loe_line = lines[i + 1].strip()
-            loe_m = re.match(r"^[A-C](?:-[A-Z]{1,2})?$", loe_line)
-            reco_m = re.match(r"^\d+\.\s+", lines[i + 2]) if i + 2 < len(lines) else None
-
-            if cor_m and loe_m and reco_m:
-                cor = cor_m.group(0).strip().title()
-                loe = loe_line.strip()
-                reco = lines[i + 2]
-                j = i + 3
-
-                while j < len(lines):
-                    line = lines[j].strip()
-                    line_lower = line.lower()
-
-                    if re.match(r"^\d+\.\s+", line) or re.match(r"^(1|2a|2b|3(?::.*)?)\b", line_lower):
-                        break
-                    if line == "":
-                        break
-                    if "synopsis" in line_lower:
-                        break
-                    if re.match(r"^[A-Z][^a-z]*[a-z]+", line) and line.endswith("."):
-                        break
-
-                    reco += " " + line
-                    j += 1
-
-                tables.append({
-                    "Page": page_num + 1,
-                    "COR": cor,
-                    "LOE": loe,
-                    "Recommendation": reco.strip()
-                })
-                i = j
-            else:
+        if cor_line.startswith("3: no") and i + 1 < len(lines):
+            if "benefit" in lower_lines[i + 1]:
+                cor_line = "3: no benefit"
                 i += 1
 
+        # LOE and the numbered recommendation are only checked after a COR hit
+        cor_m = COR_RE.match(cor_line)
+        loe_line = lines[i + 1]
+
+        if (
+            cor_m
+            and LOE_RE.match(loe_line)
+            and i + 2 < len(lines)
+            and NUM_RE.match(lines[i + 2])
+        ):
+            cor = cor_m.group(0).strip().title()
+            loe = loe_line
+            # Continuation lines are joined once at the end, not concatenated one by one
+            parts = [lines[i + 2]]
+            j = i + 3
+
+            while j < len(lines):
+                line = lines[j]
+                line_lower = lower_lines[j]
+
+                if NUM_RE.match(line) or COR_START_RE.match(line_lower):
+                    break
+                if "synopsis" in line_lower:
+                    break
+                if CAP_SENT_RE.match(line) and line.endswith("."):
+                    break
+
+                parts.append(line)
+                j += 1
+
+            tables.append({
+                "Page": page_num + 1,
+                "COR": cor,
+                "LOE": loe,
+                "Recommendation": " ".join(parts).strip()
+            })
+            i = j
+        else:
+            i += 1
+
+    return tables
+
+
+def page_text(page, blocks=False):
+    """Text of one page. With `blocks`, pages holding both markers are re-read as
+    text blocks in reading order, which keeps multi-column tables together."""
+    text = page.get_text()
+    if not blocks or "COR" not in text or "LOE" not in text:
+        return text
+    # (x0, y0, x1, y1, text, block_no, block_type); type 0 is text, 1 an image
+    return "\n".join(b[4] for b in page.get_text("blocks", sort=True) if b[6] == 0)
+
+
+# Below this many pages, starting worker processes costs more than it saves
+SERIAL_MAX_PAGES = 32
+# Pages scanned per pool task; each task opens the PDF once for all of them
+PAGES_PER_TASK = 8
+
+
+def _scan_pages(doc, page_nums, blocks=False):
+    tables = []
+    for page_num in page_nums:
+        tables.extend(scan_page_text(page_text(doc.load_page(page_num), blocks), page_num))
+    return tables
+
+
+def _process_pages(pdf_path, start, stop, blocks=False):
+    # fitz documents cannot be pickled, so each task opens (and closes) its own copy
+    with fitz.open(pdf_path) as doc:
+        return _scan_pages(doc, range(start, stop), blocks)
+
+
+def extract_strict_recommendation_blocks(pdf_path, workers=None, blocks=False):
+    """Scan every page of the PDF; pages are independent, so they are spread over
+    `workers` processes (default: one per CPU). With workers=1, or a PDF under
+    SERIAL_MAX_PAGES pages, they are scanned in this process instead.
+    `blocks` reads candidate pages block by block (see page_text)."""
+    pdf_path = str(pdf_path)
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+        if workers == 1 or page_count < SERIAL_MAX_PAGES:
+            return pd.DataFrame(_scan_pages(doc, range(page_count), blocks))
+
+    starts = range(0, page_count, PAGES_PER_TASK)
+    stops = [min(start + PAGES_PER_TASK, page_count) for start in starts]
+    tables = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Results come back in page order
+        for rows in pool.map(_process_pages, [pdf_path] * len(starts), starts, stops, [blocks] * len(starts)):
+            tables.extend(rows)
     return pd.DataFrame(tables)
 
 
-# if __name__ == "__main__":
-#     pdf_path = "rao-et-al-2025-acc-aha-acep-naemsp-scai-guideline-for-the-management-of-patients-with-acute-coronary-syndromes-a-report.pdf"
-#     df = extract_strict_recommendation_blocks(pdf_path)
-#     df.to_csv("aha_guideline_evidence_table.csv", index=False)
-#     print(f"Extracted {len(df)} recommendations -> aha_guideline_evidence_table.csv")
+if __name__ == "__main__":
+    # The guard keeps worker processes, which re-import this module under the
+    # spawn start method, from running the extraction themselves
+    parser = argparse.ArgumentParser(description="Extract COR/LOE recommendation rows from a guideline PDF")
+    parser.add_argument("pdf_path")
+    parser.add_argument("--out-csv", default="aha_guideline_evidence_table.csv")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU; 1 scans serially)")
+    parser.add_argument("--blocks", action="store_true", help="Re-read candidate pages as text blocks in reading order")
+    args = parser.parse_args()
+
+    df = extract_strict_recommendation_blocks(args.pdf_path, args.workers, args.blocks)
+    df.to_csv(args.out_csv, index=False)
+    print(f"Extracted {len(df)} recommendations -> {args.out_csv}")
@@ -2,19 +2,31 @@
 """Generate guideline QA pairs from guideline text slices."""
 
 import argparse
-import asyncio
 import csv
-import json
+import glob
 import os
 import pickle
 import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, TextIO
 
 import tqdm
 from openai import AsyncOpenAI
 
 from medal import load_dotenv_if_present, require_env
+from medal.clients import (
+    COMPLETION_TOKENS_ESTIMATE,
+    call_with_retries,
+    make_openai_async_client,
+    prewarm_connections,
+    run_async,
+    run_worker_pool,
+)
+from medal.jsonio import dumps_line, is_valid_json, iter_jsonl
+from medal.llm_cache import LLMCache, cache_key, open_cache_from_env
+from medal.ratelimit import RequestTokenLimiter, count_tokens, estimate_tokens
+from medal.schemas import parse_guideline_qa
 
 random.seed(2025)
 
@@ -22,48 +34,147 @@ random.seed(2025)
 def load_guideline_jsonl(file_path: Path) -> Dict[str, str]:
     """Load guideline text keyed by text-guideline (if present) plus index."""
     data: Dict[str, str] = {}
-    with file_path.open("r", encoding="utf-8") as f:
-        for idx, line in enumerate(f):
-            item = json.loads(line)
-            text_id = item.get("text-guideline", f"guideline_{idx}")
-            data[f"{text_id}_{idx}"] = item.get("text", "")
+    for idx, item in iter_jsonl(file_path):
+        text_id = item.get("text-guideline", f"guideline_{idx}")
+        data[f"{text_id}_{idx}"] = item.get("text", "")
     return data
 
 
-def slice_text(text: str, max_chars: int = 2000) -> List[str]:
-    slices: List[str] = []
-    current = ""
-    for para in text.split("\n\n"):
-        if len(current) + len(para) < max_chars:
-            current += para + "\n\n"
-        else:
-            slices.append(current.strip())
-            current = para + "\n\n"
-    if current.strip():
-        slices.append(current.strip())
-    return slices
+def load_guideline_inputs(pattern: str) -> Dict[str, str]:
+    """Load one guideline JSONL, or every file matching a glob pattern.
+
+    Matching files are read on a thread pool so their I/O overlaps. Keys from
+    several files are prefixed with the file's stem, since line indexes repeat.
+    """
+    paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    if not paths:
+        raise SystemExit(f"No files match {pattern}")
+    if len(paths) == 1:
+        return load_guideline_jsonl(Path(paths[0]))
+    data: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as pool:
+        for path, loaded in zip(paths, pool.map(lambda p: load_guideline_jsonl(Path(p)), paths)):
+            stem = Path(path).stem
+            data.update((f"{stem}/{key}", text) for key, text in loaded.items())
+    return data
 
 
-async def get_response_async(client: AsyncOpenAI, prompt: str, model: str, semaphore: asyncio.Semaphore) -> str:
-    async with semaphore:
+def slice_text(text: str, max_chars: int = 2000) -> Iterator[str]:
+    """Yield runs of "\n\n"-separated paragraphs, each kept under `max_chars`.
+
+    Paragraph boundaries are found with str.find and each slice is cut from
+    `text` by index once it is complete, so no paragraph list or growing
+    string is built along the way.
+    """
+    start = 0  # offset of the pending slice in `text`
+    size = 0  # its length, counting a separator after every paragraph
+    pos = 0
+    while True:
+        nxt = text.find("\n\n", pos)
+        end = len(text) if nxt < 0 else nxt
+        if size + (end - pos) < max_chars:
+            size += end - pos + 2
+        else:
+            yield text[start:start + size].strip()
+            start, size = pos, end - pos + 2
+        if nxt < 0:
+            break
+        pos = nxt + 2
+    tail = text[start:start + size].strip()
+    if tail:
+        yield tail
+
+
+def merge_short_slices(
+    slices: Iterable[str], min_tokens: int, model: Optional[str] = None, max_chars: Optional[int] = None
+) -> Iterator[str]:
+    """Join each slice under `min_tokens` with the ones after it until the run is long enough.
+
+    Such slices are mostly headings and fragments that come back as [], so
+    merging them saves a request each. A short tail joins the last slice.
+    A merge never grows a slice past `max_chars`; a run that would is sent
+    short instead, so merged slices stay within the slice_text bound.
+    """
+    pending: List[str] = []
+    pending_tokens = 0
+    pending_chars = 0
+    last = None
+    for piece in slices:
+        if pending and max_chars and pending_chars + 2 + len(piece) > max_chars:
+            if last is not None:
+                yield last
+            last = "\n\n".join(pending)
+            pending, pending_tokens, pending_chars = [], 0, 0
+        pending_chars += len(piece) + (2 if pending else 0)
+        pending.append(piece)
+        pending_tokens += count_tokens(piece, model)
+        if pending_tokens >= min_tokens:
+            if last is not None:
+                yield last
+            last = "\n\n".join(pending)
+            pending, pending_tokens, pending_chars = [], 0, 0
+    if pending:
+        tail = "\n\n".join(pending)
+        if last is not None and (not max_chars or len(last) + 2 + len(tail) <= max_chars):
+            tail = last + "\n\n" + tail
+        elif last is not None:
+            yield last
+        last = tail
+    if last is not None:
+        yield last
+
+
+async def get_response_async(
+    client: AsyncOpenAI,
+    prompt: str,
+    model: str,
+    limiter: Optional[RequestTokenLimiter] = None,
+    cache: Optional[LLMCache] = None,
+    stream: bool = False,
+) -> str:
+    key = None
+    if cache is not None:
+        key = cache_key(model, prompt, 0.2)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    tokens = estimate_tokens(prompt) + COMPLETION_TOKENS_ESTIMATE if limiter is not None else 0
+
+    async def create() -> tuple:
         completion = await client.chat.completions.create(
             model=model,
             messages=[{"role": "user", "content": prompt}],
             response_format={"type": "json_object"},
             temperature=0.2,
+            stream=stream,
+            # The final chunk then carries usage, as a non-streamed reply does
+            **({"stream_options": {"include_usage": True}} if stream else {}),
         )
-        return completion.choices[0].message.content
-
-
-async def process_guideline_slice(
-    guideline_id: str,
-    slice_id: str,
-    slice_text_value: str,
-    client: AsyncOpenAI,
-    model: str,
-    semaphore: asyncio.Semaphore,
-) -> List[dict]:
-    prompt = f"""
+        if not stream:
+            return completion.choices[0].message.content, completion.usage
+        # Tokens arrive as they are generated, so the read timeout applies
+        # per chunk rather than to the whole completion
+        parts, usage = [], None
+        async for chunk in completion:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            usage = chunk.usage or usage
+        return "".join(parts), usage
+
+    # Concurrency is bounded by the worker pool; 429s pause the shared
+    # limiter, and each attempt takes a request slot from it
+    content, usage = await call_with_retries(create, limiter, tokens=tokens)
+    actual = getattr(usage, "total_tokens", None)
+    if tokens and actual:
+        limiter.reconcile(tokens, actual)
+    # Only replies that parse are cached; a bad one is retried next run
+    if cache is not None and content and is_valid_json(content):
+        cache.set(key, content)
+    return content
+
+
+# Fixed text around each slice, built once rather than per slice
+_PROMPT_PREFIX = """
 You are an expert clinical research assistant.
 
 Given the following text from a guideline, generate **0 or 1 challenging clinical Yes/No/No evidence questions**.
@@ -76,24 +187,24 @@ Given the following text from a guideline, generate **0 or 1 challenging clinica
 Here are examples to guide your style:
 
 [
-  {{
+  {
     "question": "In adults with chronic heart failure, does exercise therapy improve quality of life?",
     "answer": "Yes",
     "category": "heart failure",
     "supporting_snippet": "The text reports improved quality of life scores with exercise therapy."
-  }},
-  {{
+  },
+  {
     "question": "For women with urinary incontinence, does pelvic floor muscle training reduce episodes of incontinence?",
     "answer": "Yes",
     "category": "urinary incontinence",
     "supporting_snippet": "The text states fewer episodes of incontinence with pelvic floor exercises."
-  }},
-  {{
+  },
+  {
     "question": "In patients without cardiovascular risk factors, does daily aspirin reduce the incidence of major cardiovascular events?",
     "answer": "No",
     "category": "cardiovascular prevention",
     "supporting_snippet": "The text states aspirin does not reduce events in low-risk individuals."
-  }}
+  }
 ]
 
 ---
@@ -103,19 +214,31 @@ Return strictly as a JSON array of objects like above.
 
 Text:
 \"\"\"
-{slice_text_value}
+"""
+_PROMPT_SUFFIX = """
 \"\"\"
 """
+
+
+def build_slice_prompt(slice_text_value: str) -> str:
+    return _PROMPT_PREFIX + slice_text_value + _PROMPT_SUFFIX
+
+
+async def process_guideline_slice(
+    guideline_id: str,
+    slice_id: str,
+    slice_text_value: str,
+    client: AsyncOpenAI,
+    model: str,
+    limiter: Optional[RequestTokenLimiter] = None,
+    cache: Optional[LLMCache] = None,
+    stream: bool = False,
+) -> List[dict]:
+    prompt = build_slice_prompt(slice_text_value)
     try:
-        result = await get_response_async(client, prompt, model, semaphore)
-        content = result.strip()
-        if content.startswith("{"):
-            print(f"Info: slice {slice_id} returned a single object, wrapping in list.")
-            content = f"[{content}]"
-        elif not content.startswith("["):
-            print(f"Warning: slice {slice_id} did not return JSON array/object, got: {content[:80]}")
-            return []
-        qa_list = json.loads(content)
+        result = await get_response_async(client, prompt, model, limiter, cache, stream)
+        # Arrays, {"questions": [...]} and single objects are all accepted
+        qa_list = parse_guideline_qa(result.strip())
         if qa_list:
             print(f"Slice {slice_id} generated {len(qa_list)} QA.")
         else:
@@ -126,13 +249,19 @@ Text:
         return []
 
 
-def save_partial_results(results: dict, output_csv_path: Path, output_pkl_path: Path) -> None:
-    output_csv_path.parent.mkdir(parents=True, exist_ok=True)
-    output_pkl_path.parent.mkdir(parents=True, exist_ok=True)
-    with output_pkl_path.open("wb") as f:
-        pickle.dump(results, f)
-    write_all_qa_to_csv(results, output_csv_path)
-    print(f"[Checkpoint] Partial results saved to: {output_csv_path} and {output_pkl_path}")
+def append_partial_results(results: dict, slice_ids: List[str], csv_file: TextIO, jsonl_file: BinaryIO) -> None:
+    """Append the given finished slices to the open partial CSV and JSONL.
+
+    Only slices finished since the last checkpoint are written, so checkpoint
+    cost stays proportional to new work instead of re-dumping everything.
+    """
+    new = {sid: results[sid] for sid in slice_ids}
+    jsonl_file.writelines(dumps_line({"slice_id": sid, **r}) for sid, r in new.items())
+    stream_qa_to_csv(new, csv.writer(csv_file))
+    # Flushed so the checkpoint is on disk even if the run dies before closing
+    jsonl_file.flush()
+    csv_file.flush()
+    print(f"[Checkpoint] {len(new)} slices appended to: {csv_file.name} and {jsonl_file.name}")
 
 
 async def process_all_guidelines(
@@ -142,104 +271,142 @@ async def process_all_guidelines(
     api_key: str,
     checkpoint_every: int,
     checkpoint_csv: Path,
-    checkpoint_pkl: Path,
+    checkpoint_jsonl: Path,
     max_chars: int,
+    limiter: Optional[RequestTokenLimiter] = None,
+    stream: bool = False,
+    min_slice_tokens: int = 0,
 ) -> dict:
-    client = AsyncOpenAI(api_key=api_key)
-    semaphore = asyncio.Semaphore(max_concurrent)
-
-    tasks = {}
-    slice_origin_map = {}
-    for guideline_id, full_text in guideline_data.items():
-        slices = slice_text(full_text, max_chars=max_chars)
-        for i, slice_content in enumerate(slices):
-            slice_id = f"{guideline_id}_slice_{i}"
-            tasks[slice_id] = asyncio.create_task(
-                process_guideline_slice(guideline_id, slice_id, slice_content, client, model, semaphore)
-            )
-            slice_origin_map[slice_id] = guideline_id
+    # The worker pool keeps at most max_concurrent requests in flight, so no
+    # more pooled connections than that are ever used
+    client = make_openai_async_client(api_key, max_connections=max_concurrent)
+    cache = open_cache_from_env()
+    await prewarm_connections(client, max_concurrent)
+
+    def guideline_slices(full_text: str) -> Iterator[str]:
+        pieces = slice_text(full_text, max_chars=max_chars)
+        return merge_short_slices(pieces, min_slice_tokens, model, max_chars) if min_slice_tokens > 0 else pieces
+
+    slices = [
+        (guideline_id, f"{guideline_id}_slice_{i}", slice_content)
+        for guideline_id, full_text in guideline_data.items()
+        for i, slice_content in enumerate(guideline_slices(full_text))
+    ]
 
     results = {}
-    pbar = tqdm.tqdm(total=len(tasks), desc="Processing slices")
-    for idx, (slice_id, task) in enumerate(tasks.items(), start=1):
+    # Finished slices not yet written to the checkpoint files
+    pending: List[str] = []
+    completed = 0
+    # The checkpoint files stay open for the run; each checkpoint appends to them
+    csv_file = jsonl_file = None
+    if checkpoint_every:
+        checkpoint_csv.parent.mkdir(parents=True, exist_ok=True)
+        checkpoint_jsonl.parent.mkdir(parents=True, exist_ok=True)
+        jsonl_file = checkpoint_jsonl.open("wb")
+        csv_file = checkpoint_csv.open("w", newline="", encoding="utf-8")
+        csv.writer(csv_file).writerow(CSV_FIELDNAMES)
+    pbar = tqdm.tqdm(
+        total=len(slices), desc="Processing slices", mininterval=0.5, miniters=max(1, len(slices) // 200)
+    )
+
+    async def run_slice(item: tuple) -> None:
+        nonlocal completed
+        guideline_id, slice_id, slice_content = item
         try:
-            result = await task
-            if result is not None:
-                results[slice_id] = {"guideline_id": slice_origin_map[slice_id], "qa_list": result}
+            result = await process_guideline_slice(
+                guideline_id, slice_id, slice_content, client, model, limiter, cache, stream
+            )
         except Exception as e:
             print(f"Task error for {slice_id}: {e}")
-        finally:
-            pbar.update(1)
+            result = None
+        if result is not None:
+            results[slice_id] = {"guideline_id": guideline_id, "qa_list": result}
+            pending.append(slice_id)
+        pbar.update(1)
+
+        completed += 1
+        if checkpoint_every and completed % checkpoint_every == 0:
+            append_partial_results(results, pending, csv_file, jsonl_file)
+            pending.clear()
 
-        if checkpoint_every and idx % checkpoint_every == 0:
-            save_partial_results(results, checkpoint_csv, checkpoint_pkl)
+    try:
+        # A fixed pool of workers handles slices in completion order, so one
+        # slow slice does not hold up the rest and no task is created per slice
+        await run_worker_pool(slices, run_slice, max_concurrent)
+    finally:
+        if checkpoint_every:
+            if pending:
+                append_partial_results(results, pending, csv_file, jsonl_file)
+            csv_file.close()
+            jsonl_file.close()
+        await client.close()
+        if cache is not None:
+            cache.close()
 
     pbar.close()
     return results
 
 
-def write_all_qa_to_csv(results: dict, output_csv_path: Path) -> None:
-    rows = []
+CSV_FIELDNAMES = ["qa_id", "slice_id", "guideline_id", "question", "answer", "category", "supporting_snippet"]
+
+
+def iter_qa_rows(results: dict) -> Iterator[tuple]:
+    """Yield one CSV row per non-empty QA item, in CSV_FIELDNAMES order, without building the full table."""
+    # qa_list items come from parse_guideline_qa: each has a question and every field
     for slice_id, slice_result in results.items():
         guideline_id = slice_result["guideline_id"]
-        qa_list = slice_result["qa_list"]
-
-        if isinstance(qa_list, dict) and "questions" in qa_list:
-            qa_items = qa_list["questions"]
-        elif isinstance(qa_list, list):
-            qa_items = qa_list
-        elif isinstance(qa_list, dict) and "question" in qa_list:
-            qa_items = [qa_list]
-        else:
-            continue
-
-        qa_items = [qa for qa in qa_items if isinstance(qa, dict) and any(qa.values())]
-        if not qa_items:
-            continue
-
-        for idx, qa in enumerate(qa_items):
-            qa_id = f"{slice_id}_{idx}"
-            rows.append(
-                {
-                    "qa_id": qa_id,
-                    "slice_id": slice_id,
-                    "guideline_id": guideline_id,
-                    "question": qa.get("question", ""),
-                    "answer": qa.get("answer", ""),
-                    "category": qa.get("category", ""),
-                    "supporting_snippet": qa.get("supporting_snippet", ""),
-                }
+        for idx, qa in enumerate(slice_result["qa_list"]):
+            yield (
+                f"{slice_id}_{idx}",
+                slice_id,
+                guideline_id,
+                qa["question"],
+                qa["answer"],
+                qa["category"],
+                qa["supporting_snippet"],
             )
 
+
+def stream_qa_to_csv(results: dict, writer) -> None:
+    """Write the QA rows of `results` to an open csv writer as they are produced."""
+    writer.writerows(iter_qa_rows(results))
+
+
+def write_all_qa_to_csv(results: dict, output_csv_path: Path) -> None:
     output_csv_path.parent.mkdir(parents=True, exist_ok=True)
-    with output_csv_path.open("w", newline="", encoding="utf-8") as csvfile:
-        fieldnames = ["qa_id", "slice_id", "guideline_id", "question", "answer", "category", "supporting_snippet"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+    # A 1 MiB buffer keeps large exports to a handful of write syscalls
+    with output_csv_path.open("w", newline="", encoding="utf-8", buffering=1 << 20) as csvfile:
+        # Plain tuples skip DictWriter's per-field lookups
+        writer = csv.writer(csvfile)
+        writer.writerow(CSV_FIELDNAMES)
+        # Rows go straight to disk; no list of rows is built
+        stream_qa_to_csv(results, writer)
 
 
 async def main() -> None:
     parser = argparse.ArgumentParser(description="Generate guideline QA pairs from guideline text.")
-    parser.add_argument("--input-jsonl", required=True, help="Path to guideline JSONL with fields text-guideline?, text.")
+    parser.add_argument("--input-jsonl", required=True, help="Path (or quoted glob, e.g. 'data/guidelines/*.jsonl') to guideline JSONL with fields text-guideline?, text.")
     parser.add_argument("--output-csv", default="data/processed/generated_guideline_QA.csv", help="CSV path for QA rows.")
     parser.add_argument("--output-pkl", default="data/processed/generated_guideline_QA.pkl", help="Pickle path for raw results.")
     parser.add_argument("--model", default="gpt-4o", help="Model to use for generation.")
     parser.add_argument("--max-concurrent", type=int, default=5, help="Max concurrent API calls.")
+    parser.add_argument("--max-rpm", type=float, default=None, help="Optional requests-per-minute cap.")
+    parser.add_argument("--max-tpm", type=float, default=None, help="Optional tokens-per-minute cap (prompt + expected completion).")
+    parser.add_argument("--stream", action="store_true", help="Stream completions token by token instead of waiting for the full response.")
     parser.add_argument("--max-chars", type=int, default=2000, help="Max characters per slice.")
+    parser.add_argument("--min-slice-tokens", type=int, default=0, help="Merge slices shorter than this many tokens into the next one (0 keeps every slice; exact with tiktoken installed).")
     parser.add_argument("--checkpoint-every", type=int, default=200, help="Checkpoint frequency (0 to disable).")
     args = parser.parse_args()
 
     load_dotenv_if_present()
     api_key = require_env("OPENAI_API_KEY")
 
-    input_path = Path(args.input_jsonl)
     output_csv = Path(args.output_csv)
     output_pkl = Path(args.output_pkl)
     partial_csv = output_csv.with_name(output_csv.stem + "_partial.csv")
-    partial_pkl = output_pkl.with_name(output_pkl.stem + "_partial.pkl")
+    partial_jsonl = output_pkl.with_name(output_pkl.stem + "_partial.jsonl")
 
-    guideline_data = load_guideline_jsonl(input_path)
+    guideline_data = load_guideline_inputs(args.input_jsonl)
     print(f"Loaded {len(guideline_data)} guideline documents")
 
     results = await process_all_guidelines(
@@ -249,8 +416,11 @@ async def main() -> None:
         api_key=api_key,
         checkpoint_every=args.checkpoint_every,
         checkpoint_csv=partial_csv,
-        checkpoint_pkl=partial_pkl,
+        checkpoint_jsonl=partial_jsonl,
         max_chars=args.max_chars,
+        limiter=RequestTokenLimiter(args.max_rpm, args.max_tpm) if args.max_rpm or args.max_tpm else None,
+        stream=args.stream,
+        min_slice_tokens=args.min_slice_tokens,
     )
 
     output_pkl.parent.mkdir(parents=True, exist_ok=True)
@@ -261,4 +431,4 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())
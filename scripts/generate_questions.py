@@ -6,13 +6,25 @@ if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 import argparse
 import asyncio
-import json
+from itertools import islice
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 from tqdm import tqdm
 
 from medal import load_dotenv_if_present, require_env
-from medal.clients import make_openai_async_client, bounded_json_chat_completion
+from medal.batch import chat_batch_line, run_batch_job
+from medal.clients import (
+    bounded_json_chat_completion,
+    bounded_json_chat_completion_multi,
+    chunked,
+    json_response_format,
+    make_openai_async_client,
+    run_async,
+    run_bounded,
+)
+from medal.jsonio import dumps_line, has_torn_tail, iter_jsonl, iter_lines, loads
+from medal.llm_cache import open_cache_from_env
+from medal.ratelimit import RequestTokenLimiter
 
 
 PROMPT_TEMPLATE = """
@@ -26,6 +38,112 @@ Return a JSON list of 2 to 4 entries, each with keys: question, answer, evidence
 Abstract:\n"""
 
 
+# The fixed text around each abstract is built once, not per DOI
+_PROMPT_PREFIX = PROMPT_TEMPLATE + '\n\n"""\n'
+_PROMPT_SUFFIX = '\n"""\n'
+
+
+def build_prompt(abstract_text: str) -> str:
+    return _PROMPT_PREFIX + abstract_text + _PROMPT_SUFFIX
+
+
+# System prompt when several abstracts share one request (--abstracts-per-call)
+MULTI_PROMPT = """
+You are an expert clinical research assistant and medical researcher.
+
+Given an abstract, generate a structured set of 2-4 challenging questions that assess intrinsic clinical understanding.
+Each question should be answerable as Yes/No/No Evidence and include optional evidence quality and discrepancy fields.
+
+Return the 2 to 4 entries as a JSON list under the key "questions", each entry with keys: question, answer, evidence-quality, discrepancy, notes.
+""".strip()
+
+
+def build_item_prompt(abstract_text: str) -> str:
+    return 'Abstract:\n"""\n' + abstract_text + _PROMPT_SUFFIX
+
+
+_DOI_KEY = b'"doi":"'
+
+
+def extract_doi_fast(line: bytes) -> Optional[bytes]:
+    """The "doi" value of a compact JSONL record, found without parsing the line.
+
+    Returns None when the line is not a complete compact record or the value
+    holds escapes, so the caller can fall back to a full parse.
+    """
+    i = line.find(_DOI_KEY)
+    if i < 0 or not line.rstrip().endswith(b"}"):
+        return None
+    i += len(_DOI_KEY)
+    j = line.find(b'"', i)
+    if j < 0 or b"\\" in line[i:j]:
+        return None
+    return line[i:j]
+
+
+def last_abstract_lines(path: Path) -> Dict[str, int]:
+    """Line number of the last record with an abstract for each DOI.
+
+    A repeated DOI keeps its last record, as it did when the whole file was
+    loaded into a dict; only these ints are held, not the abstracts.
+    """
+    last = {}
+    for i, item in iter_jsonl(path):
+        if item.get("doi") and item.get("abstract", ""):
+            last[str(item["doi"])] = i
+    return last
+
+
+def iter_jsonl_abstracts(path: Path, last_lines: Dict[str, int]) -> Iterator[Tuple[str, dict]]:
+    """Yield (doi, {abstract, publication_year}) for each record kept by last_abstract_lines."""
+    for i, item in iter_jsonl(path):
+        doi = str(item.get("doi"))
+        if last_lines.get(doi) == i:
+            yield doi, {"abstract": item["abstract"], "publication_year": item.get("publication_year")}
+
+
+def run_batch(api_key: str, model: str, items: Iterable, out_path: Path, poll_seconds: int) -> list:
+    """Generate questions for every abstract through one OpenAI Batch job.
+
+    Returns (tag, doi, payload) triples in the same shape as the live path.
+    """
+    from openai import OpenAI
+
+    client = OpenAI(api_key=api_key)
+    results = []
+    input_path = out_path.with_name(f"{out_path.stem}.batch_input.jsonl")
+    with input_path.open("wb") as w:
+        for doi, abstract_data in items:
+            abstract_text = abstract_data.get("abstract", "")
+            if not abstract_text:
+                results.append(("skip", doi, "missing_abstract"))
+                continue
+            body = {
+                "model": model,
+                "messages": [{"role": "user", "content": build_prompt(abstract_text)}],
+                "response_format": json_response_format(),
+            }
+            if not model.startswith("gpt-5"):
+                body["temperature"] = 0.2
+            w.write(dumps_line(chat_batch_line(f"doi:{doi}", body)))
+
+    replies = run_batch_job(
+        client,
+        input_path,
+        out_path.with_name(f"{out_path.stem}.batch_results.jsonl"),
+        display_name=f"MEDAL questions {out_path.stem}",
+        poll_seconds=poll_seconds,
+        object_only=False,
+    )
+    for custom_id, reply in replies.items():
+        doi = custom_id.split(":", 1)[-1]
+        if isinstance(reply, Exception):
+            results.append(("err", doi, str(reply)))
+        else:
+            results.append(("ok", doi, reply))
+    return results
+
+
 async def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-pkl", required=False, help="Path to pickle of {doi: {abstract, publication_year}}")
@@ -33,146 +151,215 @@ async def main() -> None:
     parser.add_argument("--out-jsonl", required=True, help="Path to write questions JSONL")
     parser.add_argument("--model", default="gpt-4o")
     parser.add_argument("--max-concurrent", type=int, default=8)
+    parser.add_argument("--max-rpm", type=float, default=None, help="Optional requests-per-minute cap; set a few percent below your account limit")
+    parser.add_argument("--max-tpm", type=float, default=None, help="Optional tokens-per-minute cap; calls are charged an estimate up front and corrected to reported usage")
     parser.add_argument("--errors-jsonl", required=False, help="Optional path to write per-item errors")
     parser.add_argument("--limit", type=int, default=0, help="Optional limit of abstracts to process")
+    parser.add_argument("--batch", action="store_true", help="Submit all abstracts as one OpenAI Batch job (50%% cheaper, results within 24h)")
+    parser.add_argument("--poll-seconds", type=int, default=30, help="Batch status polling interval")
+    parser.add_argument("--abstracts-per-call", type=int, default=1, help="Generate questions for up to this many abstracts in one request (1 = one request per abstract)")
     parser.add_argument("--resume", action="store_true", help="Resume from existing outputs to avoid re-generating already completed DOIs")
     args = parser.parse_args()
 
     load_dotenv_if_present()
     api_key = require_env("OPENAI_API_KEY")
 
-    # Load abstracts from either PKL or JSONL
-    pubmed_abstract_data: Dict[str, dict] = {}
-    if args.input_pkl:
-        import pickle
-        with open(args.input_pkl, "rb") as f:
-            pubmed_abstract_data = pickle.load(f)
-    elif args.input_jsonl:
-        from typing import Any
-        with open(args.input_jsonl, "r", encoding="utf-8") as f:
-            for line in f:
-                try:
-                    item = json.loads(line)
-                except Exception:
-                    continue
-                doi = item.get("doi")
-                abstract = item.get("abstract", "")
-                pub_yr = item.get("publication_year")
-                if doi and abstract:
-                    pubmed_abstract_data[str(doi)] = {"abstract": abstract, "publication_year": pub_yr}
-    else:
+    if not (args.input_pkl or args.input_jsonl):
         raise SystemExit("Provide either --input-pkl or --input-jsonl")
 
-    client = make_openai_async_client(api_key)
-    semaphore = asyncio.Semaphore(args.max_concurrent)
+    client = make_openai_async_client(api_key, max_connections=args.max_concurrent)
+    limiter = RequestTokenLimiter(args.max_rpm, args.max_tpm) if args.max_rpm or args.max_tpm else None
+    # Keyed on model + full prompt, so reruns skip finished abstracts and
+    # editing PROMPT_TEMPLATE invalidates every entry
+    cache = open_cache_from_env()
+
+    # For gpt-5, avoid temperature and set medium reasoning effort
+    use_temp = None if str(args.model).startswith("gpt-5") else 0.2
+    effort = "medium" if str(args.model).startswith("gpt-5") else None
 
     async def process_one(doi: str, abstract_data: dict):
         abstract_text = abstract_data.get("abstract", "")
         if not abstract_text:
             return ("skip", doi, "missing_abstract")
-        prompt = (
-            PROMPT_TEMPLATE
-            + "\n\n\"\"\"\n"
-            + abstract_text
-            + "\n\"\"\"\n"
-        )
+        prompt = build_prompt(abstract_text)
         try:
-            # For gpt-5, avoid temperature and set medium reasoning effort
-            use_temp = None if str(args.model).startswith("gpt-5") else 0.2
             content = await bounded_json_chat_completion(
                 client,
                 args.model,
                 prompt,
-                semaphore,
+                semaphore=None,
                 temperature=use_temp,
-                reasoning_effort="medium" if str(args.model).startswith("gpt-5") else None,
+                reasoning_effort=effort,
+                cache=cache,
+                limiter=limiter,
             )
-            parsed = json.loads(content)
+            parsed = loads(content)
             return ("ok", doi, parsed)
         except Exception as e:
             return ("err", doi, str(e))
 
-    items = list(pubmed_abstract_data.items())
-    if args.limit and args.limit > 0:
-        items = items[: args.limit]
+    async def process_group(items: list) -> list:
+        """Ask for several abstracts in one request; any the reply misses are re-asked alone."""
+        present = [(doi, data) for doi, data in items if data.get("abstract", "")]
+        if len(present) < 2:
+            return [await process_one(doi, data) for doi, data in items]
+        try:
+            replies = await bounded_json_chat_completion_multi(
+                client,
+                args.model,
+                [build_item_prompt(data["abstract"]) for _, data in present],
+                semaphore=None,
+                temperature=use_temp,
+                reasoning_effort=effort,
+                limiter=limiter,
+                system_prompt=MULTI_PROMPT,
+            )
+        except Exception:
+            replies = [None] * len(present)
+        answered = {
+            doi: r["questions"]
+            for (doi, _), r in zip(present, replies)
+            if r is not None and isinstance(r.get("questions"), list)
+        }
+        out = []
+        for doi, data in items:
+            if doi in answered:
+                out.append(("ok", doi, answered[doi]))
+            else:
+                out.append(await process_one(doi, data))
+        return out
+
     # Build skip set from existing outputs if resuming
     skip_dois = set()
     out_path = Path(args.out_jsonl)
     if args.resume and out_path.exists():
-        try:
-            with out_path.open("r", encoding="utf-8") as rf:
-                for line in rf:
-                    try:
-                        rec = json.loads(line)
-                        d = rec.get("doi")
-                        if d:
-                            skip_dois.add(str(d))
-                    except Exception:
-                        pass
-        except Exception:
-            pass
+        # Only the DOI is needed, so lines are not parsed unless the byte scan
+        # fails; a torn final line from an interrupted run is skipped
+        for _, line in iter_lines(out_path):
+            d = extract_doi_fast(line)
+            if d is not None:
+                d = d.decode("utf-8")
+            else:
+                try:
+                    d = loads(line).get("doi")
+                except Exception:
+                    continue
+            if d:
+                skip_dois.add(str(d))
     if skip_dois:
-        items = [(d, v) for (d, v) in items if str(d) not in skip_dois]
         print(f"Resuming: skipping {len(skip_dois)} DOIs already present in {out_path}")
 
-    tasks = [process_one(doi, data) for doi, data in items]
-    out_path = Path(args.out_jsonl)
+    # Load abstracts from either PKL or JSONL. JSONL is read lazily, so
+    # abstracts are only in memory while their request is in flight
+    if args.input_pkl:
+        import pickle
+        with open(args.input_pkl, "rb") as f:
+            pubmed_abstract_data: Dict[str, dict] = pickle.load(f)
+        source = pubmed_abstract_data.items()
+        dois = list(pubmed_abstract_data)
+    else:
+        # A first pass finds each DOI's record, so repeated DOIs are sent once
+        # and the progress total counts distinct DOIs rather than raw lines
+        last_lines = last_abstract_lines(Path(args.input_jsonl))
+        source = iter_jsonl_abstracts(Path(args.input_jsonl), last_lines)
+        dois = sorted(last_lines, key=last_lines.get)
+    if args.limit and args.limit > 0:
+        source = islice(source, args.limit)
+        dois = dois[: args.limit]
+    total = sum(1 for doi in dois if str(doi) not in skip_dois)
+
+    abstracts = ((doi, data) for doi, data in source if str(doi) not in skip_dois)
+
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
     err_writer = None
     if args.errors_jsonl:
         err_path = Path(args.errors_jsonl)
         err_path.parent.mkdir(parents=True, exist_ok=True)
-        err_writer = err_path.open("w", encoding="utf-8")
+        err_writer = err_path.open("wb")
 
     ok_count = 0
     skip_count = 0
     err_count = 0
 
-    write_mode = "a" if args.resume and out_path.exists() else "w"
-    with out_path.open(write_mode, encoding="utf-8") as w:
-        for coro in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Generating"):
-            tag, doi, payload = await coro
-            if tag == "skip":
-                skip_count += 1
-                if err_writer:
-                    err_writer.write(json.dumps({"doi": doi, "error": payload}) + "\n")
-                continue
-            if tag == "err":
-                err_count += 1
-                if err_writer:
-                    err_writer.write(json.dumps({"doi": doi, "error": payload}) + "\n")
-                continue
-            # ok path
-            qa_list = payload
-            ok_count += 1
-            if isinstance(qa_list, dict) and "question" in qa_list:
-                qa_items = [qa_list]
-            elif isinstance(qa_list, list):
-                qa_items = qa_list
+    def write_results(results: list) -> None:
+        for result in results:
+            write_result(*result)
+
+    def write_result(tag: str, doi: str, payload) -> None:
+        nonlocal ok_count, skip_count, err_count
+        progress.update(1)
+        if tag == "skip":
+            skip_count += 1
+            if err_writer:
+                err_writer.write(dumps_line({"doi": doi, "error": payload}))
+            return
+        if tag == "err":
+            err_count += 1
+            if err_writer:
+                err_writer.write(dumps_line({"doi": doi, "error": payload}))
+            return
+        # ok path
+        qa_list = payload
+        ok_count += 1
+        if isinstance(qa_list, dict) and "question" in qa_list:
+            qa_items = [qa_list]
+        elif isinstance(qa_list, list):
+            qa_items = qa_list
+        else:
+            # unexpected shape
+            if err_writer:
+                err_writer.write(dumps_line({"doi": doi, "error": "invalid_shape"}))
+            return
+        for qa in qa_items:
+            qa_record = {
+                "doi": doi,
+                "question": qa.get("question", ""),
+                "answer": qa.get("answer", ""),
+                "evidence-quality": qa.get("evidence-quality", "Missing"),
+                "discrepancy": qa.get("discrepancy", "Missing"),
+                "notes": qa.get("notes", ""),
+            }
+            w.write(dumps_line(qa_record))
+
+    write_mode = "ab" if args.resume and out_path.exists() else "wb"
+    try:
+        with out_path.open(write_mode) as w:
+            if write_mode == "ab" and has_torn_tail(out_path):
+                # Start after a torn final line rather than appending to it
+                w.write(b"\n")
+            progress = tqdm(
+                total=total,
+                desc="Generating",
+                mininterval=0.5,
+                miniters=max(1, total // 200),
+            )
+            if args.batch:
+                write_results(
+                    await asyncio.to_thread(run_batch, api_key, args.model, abstracts, out_path, args.poll_seconds)
+                )
             else:
-                # unexpected shape
-                if err_writer:
-                    err_writer.write(json.dumps({"doi": doi, "error": "invalid_shape"}) + "\n")
-                continue
-            for qa in qa_items:
-                qa_record = {
-                    "doi": doi,
-                    "question": qa.get("question", ""),
-                    "answer": qa.get("answer", ""),
-                    "evidence-quality": qa.get("evidence-quality", "Missing"),
-                    "discrepancy": qa.get("discrepancy", "Missing"),
-                    "notes": qa.get("notes", ""),
-                }
-                w.write(json.dumps(qa_record) + "\n")
+                # Concurrency counts requests, however many abstracts each carries
+                groups = chunked(abstracts, max(1, args.abstracts_per_call))
+                await run_bounded(
+                    groups,
+                    process_group,
+                    args.max_concurrent,
+                    write_results,
+                )
+            progress.close()
+    finally:
+        await client.close()
 
     if err_writer:
         err_writer.close()
+    if cache is not None:
+        cache.close()
     print(f"Done. ok={ok_count} err={err_count} skip={skip_count}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())
 
 
 
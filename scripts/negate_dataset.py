@@ -7,14 +7,18 @@ if str(ROOT_DIR) not in sys.path:
 import argparse
 import asyncio
 import json
+from collections import Counter
 from pathlib import Path
 
 from medal import load_dotenv_if_present, require_env
-from medal.clients import make_openai_async_client, bounded_json_chat_completion
+from medal.clients import make_openai_async_client, bounded_json_chat_completion, error_category, run_async, run_bounded, run_worker_pool
+from medal.jsonio import dumps_line, iter_jsonl, loads
+from medal.llm_cache import open_cache_from_env
+from medal.ratelimit import RequestTokenLimiter
+from medal.semantic_cache import SemanticCache
 
 
-def build_negation_prompt(entry: dict) -> str:
-    return f"""
+NEGATION_INSTRUCTIONS = """
 You are a clinical research expert.
 Negate the 'question' and 'answer' fields following rules:
 - Prefer antonymic verb flips (increase/decrease, improve/worsen, promote/inhibit) over 'does not ...'.
@@ -22,18 +26,40 @@ Negate the 'question' and 'answer' fields following rules:
 - If original answer is "No Evidence", leave it as "No Evidence".
 
 Return ONLY a JSON object with keys: doi, question, answer, original_question, original_answer, evidence-quality, discrepancy.
+""".strip()
+
+
+def build_negation_prompt(entry: dict) -> str:
+    """Per-entry user message; the fixed NEGATION_INSTRUCTIONS go in the system prompt."""
+    # json.dumps escapes quotes, backslashes and newlines in every field
+    original = {
+        "doi": entry.get("doi", ""),
+        "question": entry.get("question", ""),
+        "answer": entry.get("answer", ""),
+        "evidence-quality": entry.get("evidence-quality", ""),
+        "discrepancy": entry.get("discrepancy", ""),
+    }
+    return "Original:\n" + json.dumps(original, ensure_ascii=False, indent=2)
 
-Original:
-{{
-  "doi": "{entry.get('doi','')}",
-  "question": "{entry.get('question','').replace('"','\\"')}",
-  "answer": "{entry.get('answer','')}",
-  "evidence-quality": "{entry.get('evidence-quality','')}",
-  "discrepancy": "{entry.get('discrepancy','')}"
-}}
+
+REPAIR_TEMPLATE = """
+{original}
+
+Your previous negation was invalid:
+{previous}
+
+The negated answer must flip the original answer (Yes <-> No), and "No Evidence" must stay "No Evidence". If negation is not logically derivable, use "Not applicable". Please try again.
 """.strip()
 
 
+def build_repair_prompt(entry: dict, previous: dict) -> str:
+    """Re-ask for an entry whose first negation failed `negation_valid`."""
+    return REPAIR_TEMPLATE.format(
+        original=build_negation_prompt(entry),
+        previous=json.dumps(previous, ensure_ascii=False, indent=2),
+    )
+
+
 def negation_valid(original: str, negated: str) -> bool:
     if original == "Yes" and negated == "No":
         return True
@@ -50,51 +76,142 @@ async def main() -> None:
     parser.add_argument("--out-jsonl", required=True)
     parser.add_argument("--model", default="gpt-4o-mini")
     parser.add_argument("--max-concurrent", type=int, default=5)
+    parser.add_argument("--max-rpm", type=float, default=None, help="Optional requests-per-minute cap; set a few percent below your account limit")
+    parser.add_argument("--max-tpm", type=float, default=None, help="Optional tokens-per-minute cap; calls are charged an estimate up front and corrected to reported usage")
+    parser.add_argument("--semantic-cache", required=False, help="Optional .npz path; reuse negations of near-duplicate questions across runs")
+    parser.add_argument("--similarity-threshold", type=float, default=0.97, help="Cosine similarity above which a cached negation is reused")
+    parser.add_argument("--embedding-model", default="text-embedding-3-small")
+    parser.add_argument("--repair-attempts", type=int, default=1, help="Times to re-ask when a negation fails validation (0 disables)")
     args = parser.parse_args()
 
     load_dotenv_if_present()
     api_key = require_env("OPENAI_API_KEY")
-    client = make_openai_async_client(api_key)
+    client = make_openai_async_client(api_key, max_connections=args.max_concurrent)
+    limiter = RequestTokenLimiter(args.max_rpm, args.max_tpm) if args.max_rpm or args.max_tpm else None
     semaphore = asyncio.Semaphore(args.max_concurrent)
-
-    inputs = []
-    with open(args.input_jsonl, "r", encoding="utf-8") as f:
-        for line in f:
+    # Exact repeats of an entry produce the same prompt, so with
+    # MEDAL_LLM_CACHE set they (and reruns) are answered from disk
+    cache = open_cache_from_env()
+    semantic_cache = None
+    if args.semantic_cache:
+        semantic_cache = SemanticCache.load(Path(args.semantic_cache), threshold=args.similarity_threshold)
+        print(f"Loaded {len(semantic_cache)} cached negations from {args.semantic_cache}")
+
+    async def embed(text: str):
+        async with semaphore:
+            resp = await client.embeddings.create(model=args.embedding_model, input=text)
+        return resp.data[0].embedding
+
+    def reuse_cached(entry: dict, cached: dict) -> dict:
+        data = dict(cached)
+        data["doi"] = entry.get("doi", "")
+        data["original_question"] = entry.get("question", "")
+        data["evidence-quality"] = entry.get("evidence-quality", "")
+        data["discrepancy"] = entry.get("discrepancy", "")
+        return data
+
+    use_temp = None if str(args.model).startswith("gpt-5") else 0.2
+    effort = "medium" if str(args.model).startswith("gpt-5") else None
+
+    async def ask(prompt: str) -> dict:
+        content = await bounded_json_chat_completion(
+            client,
+            args.model,
+            prompt,
+            semaphore,
+            temperature=use_temp,
+            reasoning_effort=effort,
+            system_prompt=NEGATION_INSTRUCTIONS,
+            cache=cache,
+            limiter=limiter,
+        )
+        data = loads(content)
+        # Valid JSON of another shape would fail later, outside the counted try blocks
+        if not isinstance(data, dict):
+            raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+        return data
+
+    # Negation runs as a two-stage pipeline: stage 1 makes the first LLM call,
+    # stage 2 validates and re-asks invalid negations, so repairs never hold
+    # up first-pass throughput
+    to_validate: asyncio.Queue = asyncio.Queue(maxsize=args.max_concurrent * 2)
+    # Failures by error_category, reported at the end instead of passing silently
+    errors: Counter = Counter()
+
+    async def negate(entry: dict) -> None:
+        embedding = None
+        try:
+            if semantic_cache is not None:
+                embedding = await embed(entry.get("question", ""))
+                cached = semantic_cache.lookup(embedding)
+                # A paraphrase only shares a negation if the original answers agree
+                if cached is not None and cached.get("original_answer") == entry.get("answer", ""):
+                    await to_validate.put((entry, reuse_cached(entry, cached), None))
+                    return
+            data = await ask(build_negation_prompt(entry))
+        except Exception as e:
+            # Transient API errors were already retried inside the call; the
+            # entry is dropped from the output but counted
+            errors[error_category(e)] += 1
+            return
+        await to_validate.put((entry, data, embedding))
+
+    async def validate(job: tuple) -> dict:
+        entry, data, embedding = job
+        original = entry.get("answer", "")
+        valid = negation_valid(original, data.get("answer", ""))
+        attempts = 0
+        # "Not applicable" is an allowed outcome, not a failed negation
+        while not valid and data.get("answer") != "Not applicable" and attempts < args.repair_attempts:
+            attempts += 1
             try:
-                inputs.append(json.loads(line))
-            except Exception:
-                pass
-
-    async def process_one(entry: dict):
-        prompt = build_negation_prompt(entry)
+                data = await ask(build_repair_prompt(entry, data))
+            except Exception as e:
+                errors[f"repair_{error_category(e)}"] += 1
+                break
+            valid = negation_valid(original, data.get("answer", ""))
+        data["negation-valid"] = valid
+        if embedding is not None:
+            data["original_answer"] = original
+            semantic_cache.add(embedding, data)
+        return data
+
+    async def first_pass(entries) -> None:
         try:
-            use_temp = None if str(args.model).startswith("gpt-5") else 0.2
-            content = await bounded_json_chat_completion(
-                client,
-                args.model,
-                prompt,
-                semaphore,
-                temperature=use_temp,
-                reasoning_effort="medium" if str(args.model).startswith("gpt-5") else None,
-            )
-            data = json.loads(content)
-            data["negation-valid"] = negation_valid(entry.get("answer", ""), data.get("answer", ""))
-            return data
-        except Exception:
-            return None
+            await run_worker_pool(entries, negate, args.max_concurrent)
+        finally:
+            await to_validate.put(None)
+
+    async def first_pass_results():
+        while (job := await to_validate.get()) is not None:
+            yield job
 
-    tasks = [process_one(item) for item in inputs]
     out_path = Path(args.out_jsonl)
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", encoding="utf-8") as w:
-        for coro in asyncio.as_completed(tasks):
-            item = await coro
-            if item:
-                w.write(json.dumps(item) + "\n")
+    # Entries are parsed as workers pull them, so the input is never held in memory
+    try:
+        with out_path.open("wb") as w:
+            entries = (
+                entry
+                for _, entry in iter_jsonl(args.input_jsonl, on_error=lambda i, e: errors.update(["input"]))
+            )
+            await asyncio.gather(
+                first_pass(entries),
+                run_bounded(first_pass_results(), validate, args.max_concurrent, lambda data: w.write(dumps_line(data))),
+            )
+    finally:
+        await client.close()
+        if cache is not None:
+            cache.close()
+
+    if semantic_cache is not None:
+        semantic_cache.save(Path(args.semantic_cache))
+    summary = " ".join(f"{k}={v}" for k, v in sorted(errors.items())) or "none"
+    print(f"Done. errors: {summary}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())
 
 
 
@@ -5,13 +5,23 @@ ROOT_DIR = _P(__file__).resolve().parents[1]
 if str(ROOT_DIR) not in sys.path:
     sys.path.insert(0, str(ROOT_DIR))
 import argparse
-import asyncio
 import json
+from collections import Counter
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
 
 from medal import load_dotenv_if_present, require_env
-from medal.clients import make_openai_async_client, bounded_json_chat_completion
+from medal.clients import (
+    bounded_json_chat_completion,
+    bounded_json_chat_completion_multi,
+    error_category,
+    make_openai_async_client,
+    run_async,
+    run_bounded,
+)
+from medal.jsonio import dumps_line, iter_jsonl, loads
+from medal.llm_cache import open_cache_from_env
+from medal.ratelimit import RequestTokenLimiter
 
 
 REFINE_PROMPT = (
@@ -43,67 +53,132 @@ async def main() -> None:
     parser.add_argument("--out-jsonl", required=True, help="Output JSONL of refined QA items (same schema)")
     parser.add_argument("--model", default="gpt-4o")
     parser.add_argument("--max-concurrent", type=int, default=8)
+    parser.add_argument("--max-rpm", type=float, default=None, help="Optional requests-per-minute cap; set a few percent below your account limit")
+    parser.add_argument("--max-tpm", type=float, default=None, help="Optional tokens-per-minute cap; calls are charged an estimate up front and corrected to reported usage")
+    parser.add_argument("--items-per-call", type=int, default=1, help="Refine up to this many items from the same DOI in one request (1 = one request per item)")
     args = parser.parse_args()
 
     load_dotenv_if_present()
     api_key = require_env("OPENAI_API_KEY")
-    client = make_openai_async_client(api_key)
-    semaphore = asyncio.Semaphore(args.max_concurrent)
-
-    records = []
-    with open(args.input_jsonl, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                item = json.loads(line)
-                records.append(item)
-            except Exception:
-                pass
+    client = make_openai_async_client(api_key, max_connections=args.max_concurrent)
+    limiter = RequestTokenLimiter(args.max_rpm, args.max_tpm) if args.max_rpm or args.max_tpm else None
+    # Repeated QA items produce the same prompt, so with MEDAL_LLM_CACHE set
+    # they (and reruns) are answered from disk
+    cache = open_cache_from_env()
 
-    async def refine_one(item: dict):
-        qa = {
+    # Failures by error_category, reported at the end instead of passing silently
+    errors: Counter = Counter()
+
+    # Unparseable lines are skipped (and counted)
+    records = [
+        item for _, item in iter_jsonl(args.input_jsonl, on_error=lambda i, e: errors.update(["input"]))
+    ]
+
+    use_temp = None if str(args.model).startswith("gpt-5") else 0.1
+    effort = "medium" if str(args.model).startswith("gpt-5") else None
+
+    def proposed_qa(item: dict) -> dict:
+        return {
             "question": item.get("question", ""),
             "answer": item.get("answer", ""),
             "evidence-quality": item.get("evidence-quality", ""),
             "discrepancy": item.get("discrepancy", ""),
             "notes": item.get("notes", ""),
         }
-        prompt = f"{REFINE_PROMPT}\n\nProposed QA item:\n```json\n{json.dumps(qa, ensure_ascii=False)}\n```"
+
+    def item_prompt(qa: dict) -> str:
+        return f"Proposed QA item:\n```json\n{json.dumps(qa, ensure_ascii=False)}\n```"
+
+    def refined_record(item: dict, qa: dict, refined: dict) -> dict:
+        # keep original doi if present
+        return {
+            "doi": item.get("doi", ""),
+            "question": refined.get("question", qa["question"]),
+            "answer": refined.get("answer", qa["answer"]),
+            "evidence-quality": refined.get("evidence-quality", qa["evidence-quality"]),
+            "discrepancy": refined.get("discrepancy", qa["discrepancy"]),
+            "notes": refined.get("notes", qa["notes"]),
+        }
+
+    async def refine_one(item: dict):
+        qa = proposed_qa(item)
+        prompt = f"{REFINE_PROMPT}\n\n{item_prompt(qa)}"
         try:
-            use_temp = None if str(args.model).startswith("gpt-5") else 0.1
             content = await bounded_json_chat_completion(
                 client,
                 args.model,
                 prompt,
-                semaphore,
+                semaphore=None,
                 temperature=use_temp,
-                reasoning_effort="medium" if str(args.model).startswith("gpt-5") else None,
+                reasoning_effort=effort,
+                cache=cache,
+                limiter=limiter,
             )
-            refined = json.loads(content)
+            refined = loads(content)
+            # Valid JSON of another shape would fail later in refined_record, uncounted
+            if not isinstance(refined, dict):
+                raise ValueError(f"expected a JSON object, got {type(refined).__name__}")
         except Exception as e:
+            # Transient API errors were already retried inside the call
+            errors[error_category(e)] += 1
             refined = qa
             refined["notes"] = (refined.get("notes", "") + f" | refine_error: {e}").strip()
-        # keep original doi if present
-        refined_record = {
-            "doi": item.get("doi", ""),
-            "question": refined.get("question", qa["question"]),
-            "answer": refined.get("answer", qa["answer"]),
-            "evidence-quality": refined.get("evidence-quality", qa["evidence-quality"]),
-            "discrepancy": refined.get("discrepancy", qa["discrepancy"]),
-            "notes": refined.get("notes", qa["notes"]),
-        }
-        return refined_record
+        return refined_record(item, qa, refined)
+
+    async def refine_group(items: List[dict]) -> List[dict]:
+        """Refine items sharing a DOI in one request; anything the reply misses is re-asked alone."""
+        if len(items) == 1:
+            return [await refine_one(items[0])]
+        qas = [proposed_qa(item) for item in items]
+        try:
+            refined = await bounded_json_chat_completion_multi(
+                client,
+                args.model,
+                [item_prompt(qa) for qa in qas],
+                semaphore=None,
+                temperature=use_temp,
+                reasoning_effort=effort,
+                limiter=limiter,
+                system_prompt=REFINE_PROMPT,
+            )
+        except Exception:
+            refined = [None] * len(items)
+        out = []
+        for item, qa, r in zip(items, qas, refined):
+            out.append(refined_record(item, qa, r) if r is not None else await refine_one(item))
+        return out
+
+    # Items from the same DOI share their abstract context, so they are the
+    # ones grouped into a single request
+    by_doi: Dict[str, List[dict]] = {}
+    for item in records:
+        by_doi.setdefault(item.get("doi", ""), []).append(item)
+    size = max(1, args.items_per_call)
+    groups = [
+        items[i:i + size] for items in by_doi.values() for i in range(0, len(items), size)
+    ]
 
-    tasks = [refine_one(item) for item in records]
     out_path = Path(args.out_jsonl)
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("w", encoding="utf-8") as w:
-        for coro in asyncio.as_completed(tasks):
-            rec = await coro
-            if rec:
-                w.write(json.dumps(rec) + "\n")
+
+    def write_group(recs: List[dict]) -> None:
+        w.writelines(dumps_line(rec) for rec in recs if rec)
+
+    try:
+        with out_path.open("wb") as w:
+            # Groups are written by a single writer as soon as they are refined,
+            # in completion order, without a coroutine per group up front
+            await run_bounded(groups, refine_group, args.max_concurrent, write_group)
+    finally:
+        await client.close()
+        if cache is not None:
+            cache.close()
+
+    summary = " ".join(f"{k}={v}" for k, v in sorted(errors.items())) or "none"
+    print(f"Done. {len(records)} items; errors: {summary}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())
 
 
@@ -1,22 +1,27 @@
-import json
+import sys
+from pathlib import Path as _P
+ROOT_DIR = _P(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+import argparse
 import asyncio
-import os
-import pandas as pd
-from typing import Dict
+import csv
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
 from tqdm.asyncio import tqdm
 from openai import AsyncOpenAI
 
-# === Load and preprocess CSV ===
-csv_path = "aha_guideline_evidence_cleaned.csv"
-df = pd.read_csv(csv_path)
-
-# === Initialize OpenAI client ===
-api_key = os.getenv("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=api_key)
+from medal import load_dotenv_if_present, require_env
+from medal.batch import chat_batch_line, run_batch_job
+from medal.clients import call_with_retries, make_openai_async_client, run_async, run_worker_pool
+from medal.jsonio import dumps_line, has_torn_tail, iter_jsonl, loads, write_json
+from medal.ratelimit import AsyncRateLimiter
 
 # === Prompt template ===
-def build_prompt(recommendation):
-    return f"""You are a clinical guideline reviewer.
+# The instructions and output format are identical for every recommendation, so
+# they are sent as a fixed system message; OpenAI caches repeated prompt
+# prefixes, leaving only the short per-recommendation user message uncached
+SYSTEM_PROMPT = """You are a clinical guideline reviewer.
 
 You will be given one clinical recommendation. Based on your expertise and reasoning, answer the following:
 
@@ -27,83 +32,206 @@ You will be given one clinical recommendation. Based on your expertise and reaso
 5. Is it supported by observational or nonrandomized studies? Answer "Yes", "No", or "Unknown".
 6. Is it a concensus of expert opinion based on clinical experience? Answer "Yes", "No", or "Unknown".
 
-
-Here is the recommendation:
-\"\"\"{recommendation}\"\"\"
-
 Return your answer in JSON format like this:
-{{
+{
   "supported": "Yes" or "No" or "Unknown",
   "recommendation_strength": 1-5,
   "evidence_quality":1-5,
   "based_on_rct": "Yes" or "No" or "Unknown",
   "based_on_observational": "Yes" or "No" or "Unknown",
   "based_on_expert_opinion": "Yes" or "No" or "Unknown"
-}}"""
+}"""
+
+
+_PROMPT_PREFIX = 'Here is the recommendation:\n"""'
+_PROMPT_SUFFIX = '"""'
+
+
+def build_prompt(recommendation):
+    return _PROMPT_PREFIX + str(recommendation) + _PROMPT_SUFFIX
+
+
+def build_messages(recommendation) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": build_prompt(recommendation)},
+    ]
+
+def request_body(model: str, messages: list) -> dict:
+    """Chat completion parameters shared by the live and Batch API paths."""
+    body = {"model": model, "messages": messages, "response_format": {"type": "json_object"}}
+    # gpt-5 models reject a custom temperature
+    if not model.startswith("gpt-5"):
+        body["temperature"] = 0.2
+    return body
+
+
+def error_response(error) -> dict:
+    return {
+        "supported": "ERROR",
+        "recommendation_strength": "ERROR",
+        "evidence_quality": "ERROR",
+        "based_on_rct": "ERROR",
+        "based_on_observational": "ERROR",
+        "based_on_expert_opinion": "ERROR",
+        "error": str(error)
+    }
+
+
+def make_result(row, response: dict) -> dict:
+    return {
+        "recommendation": row["Recommendation"],
+        "model_supported": response.get("supported", ""),
+        "model_recommendation_strength": response.get("recommendation_strength", ""),
+        "model_evidence_quality": response.get("evidence_quality", ""),
+        "model_based_on_rct": response.get("based_on_rct", ""),
+        "model_based_on_observational": response.get("based_on_observational", ""),
+        "model_based_on_expert_opinion": response.get("based_on_expert_opinion", ""),
+        "ground_truth_loe": row["LOE"],
+        "ground_truth_cor": row["COR"],
+        "source_file": row["SourceFile"]
+    }
+
+# === Batch API (half price, results within 24h) ===
+def run_batch(api_key: str, model: str, rows: List[dict], out_path: Path, poll_seconds: int) -> dict:
+    from openai import OpenAI
+
+    client = OpenAI(api_key=api_key)
+    input_path = out_path.with_name(f"{out_path.stem}.batch_input.jsonl")
+    with input_path.open("wb") as w:
+        for pos, row in enumerate(rows):
+            body = request_body(model, build_messages(row["Recommendation"]))
+            w.write(dumps_line(chat_batch_line(f"row:{pos}", body)))
+
+    replies = run_batch_job(
+        client,
+        input_path,
+        out_path.with_name(f"{out_path.stem}.batch_results.jsonl"),
+        display_name=f"MEDAL guideline QA {out_path.stem}",
+        poll_seconds=poll_seconds,
+    )
+    responses = {
+        custom_id: error_response(reply) if isinstance(reply, Exception) else reply
+        for custom_id, reply in replies.items()
+    }
+
+    return {
+        row["id"]: make_result(row, responses.get(f"row:{pos}") or error_response("missing from batch output"))
+        for pos, row in enumerate(rows)
+    }
+
+# === Checkpointing ===
+def load_checkpoint(path: Path) -> dict:
+    """Results already written to an append-only checkpoint, keyed by recommendation id."""
+    done = {}
+    if not path.exists():
+        return done
+    # A crash can leave the last line half-written; iter_jsonl skips it and that row is simply redone
+    for _, item in iter_jsonl(path):
+        if isinstance(item, dict) and "id" in item and "result" in item:
+            done[item["id"]] = item["result"]
+    return done
 
 # === Async request handler ===
-async def get_response_async(client, prompt, model, semaphore):
-    async with semaphore:
-        completion = await client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            temperature=0.2,
-        )
-        return completion.choices[0].message.content
+async def get_response_async(client, messages, model, limiter: Optional[AsyncRateLimiter] = None):
+    # 429/5xx/timeouts back off (honouring Retry-After) instead of becoming ERROR rows
+    completion = await call_with_retries(
+        lambda: client.chat.completions.create(**request_body(model, messages)),
+        limiter,
+    )
+    return completion.choices[0].message.content
 
 # === Main evaluation ===
-async def evaluate_recommendations(model="gpt-4o-mini", max_concurrent=10):
-    semaphore = asyncio.Semaphore(max_concurrent)
+async def evaluate_recommendations(
+    client: AsyncOpenAI,
+    rows: List[dict],
+    model="gpt-4o-mini",
+    max_concurrent=10,
+    limiter: Optional[AsyncRateLimiter] = None,
+    checkpoint: Optional[BinaryIO] = None,
+):
     results = {}
 
     async def evaluate_row(row):
         rid = row["id"]
-        rec = row["Recommendation"]
-        prompt = build_prompt(rec)
-
         try:
-            response_str = await get_response_async(client, prompt, model, semaphore)
-            response = json.loads(response_str)
+            response = loads(await get_response_async(client, build_messages(row["Recommendation"]), model, limiter))
+            if not isinstance(response, dict):
+                raise ValueError(f"reply is a JSON {type(response).__name__}, not an object")
         except Exception as e:
-            response = {
-                "supported": "ERROR",
-                "recommendation_strength": "ERROR",
-                "evidence_quality": "ERROR",
-                "based_on_rct": "ERROR",
-                "based_on_observational": "ERROR",
-                "based_on_expert_opinion": "ERROR",
-                "error": str(e)
-            }
-
-        results[rid] = {
-            "recommendation": rec,
-            "model_supported": response.get("supported", ""),
-            "model_recommendation_strength": response.get("recommendation_strength", ""),
-            "model_evidence_quality": response.get("evidence_quality", ""),
-            "model_based_on_rct": response.get("based_on_rct", ""),
-            "model_based_on_observational": response.get("based_on_observational", ""),
-            "model_based_on_expert_opinion": response.get("based_on_expert_opinion", ""),
-            "ground_truth_loe": row["LOE"],
-            "ground_truth_cor": row["COR"],
-            "source_file": row["SourceFile"]
-        }
-
-    tasks = [evaluate_row(row) for _, row in df.iterrows()]
-    pbar = tqdm(total=len(tasks), desc="Evaluating Recommendations")
-    
-
-    for coro in asyncio.as_completed(tasks):
-        await coro
-        pbar.update(1)
-
+            print(f"Recommendation {rid} failed: {e}")
+            response = error_response(e)
+
+        results[rid] = make_result(row, response)
+        if checkpoint is not None:
+            # One line per finished row, so a crash loses at most the rows in flight
+            checkpoint.write(dumps_line({"id": rid, "result": results[rid]}, default=str))
+
+        # The bar is advanced in ~1% steps rather than once per row
+        nonlocal done
+        done += 1
+        if done % step == 0:
+            pbar.update(done - pbar.n)
+
+    done = 0
+    step = max(1, len(rows) // 100)
+    pbar = tqdm(total=len(rows), desc="Evaluating Recommendations", mininterval=0.5)
+    # max_concurrent workers pull rows from a bounded queue; no task or
+    # semaphore waiter is created per row
+    await run_worker_pool(rows, evaluate_row, max_concurrent)
+    pbar.update(done - pbar.n)
     pbar.close()
     return results
 
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Evaluate guideline recommendations against their LOE/COR labels")
+    parser.add_argument("--input-csv", default="aha_guideline_evidence_cleaned.csv")
+    parser.add_argument("--out-json", default="evidence_eval_results.json")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--max-concurrent", type=int, default=50, help="Max requests in flight")
+    parser.add_argument("--max-rpm", type=float, default=None, help="Optional requests-per-minute cap; set a few percent below your account limit")
+    parser.add_argument("--batch", action="store_true", help="Submit all recommendations as one OpenAI Batch job (50%% cheaper, results within 24h)")
+    parser.add_argument("--poll-seconds", type=int, default=30, help="Batch status polling interval")
+    args = parser.parse_args()
+
+    load_dotenv_if_present()
+    api_key = require_env("OPENAI_API_KEY")
+
+    # Cells are read as plain strings; there is no per-row Series boxing
+    with open(args.input_csv, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    out_path = Path(args.out_json)
+    checkpoint_path = out_path.with_name(f"{out_path.stem}.checkpoint.jsonl")
+    if args.batch:
+        results = await asyncio.to_thread(
+            run_batch, api_key, args.model, rows, out_path, args.poll_seconds
+        )
+    else:
+        results = load_checkpoint(checkpoint_path)
+        if results:
+            print(f"Resuming from checkpoint: {len(results)} already completed")
+            rows = [row for row in rows if row["id"] not in results]
+        client = make_openai_async_client(api_key, max_connections=args.max_concurrent)
+        limiter = AsyncRateLimiter(args.max_rpm, 60) if args.max_rpm else None
+        try:
+            torn = checkpoint_path.exists() and has_torn_tail(checkpoint_path)
+            with checkpoint_path.open("ab", buffering=0) as checkpoint:
+                if torn:
+                    # Start after a torn final line rather than appending to it
+                    checkpoint.write(b"\n")
+                results.update(
+                    await evaluate_recommendations(client, rows, args.model, args.max_concurrent, limiter, checkpoint)
+                )
+        finally:
+            await client.close()
+
+    write_json(out_path, results, default=str)
+
+    # Remove checkpoint file on successful completion
+    if checkpoint_path.exists():
+        checkpoint_path.unlink()
+
+
 # === Run the script ===
 if __name__ == "__main__":
-    output_file = "evidence_eval_results.json"
-    results = asyncio.run(evaluate_recommendations())
-    with open(output_file, "w") as f:
-        json.dump(results, f, indent=2)
-
+    run_async(main())